@@ -20,23 +20,14 @@ This is the main node script for Apache Warble (incubating)
 """
 _VERSION = '0.1.0'
 
-# Basic imports
+# Basic imports. Anything heavier is imported further down, once we know
+# we are not just printing our version or fingerprint.
 import os
 import sys
 import stat
 import time
-import ruamel.yaml
-import requests
-import datetime
 import argparse
 import socket
-import base64
-import json
-
-# Warble-specific libraries
-import plugins.tests
-import plugins.basics.misc
-import plugins.basics.crypto
 
 basepath = os.path.dirname(os.path.realpath(__file__))
 configpath = "%s/conf/node.yaml" % basepath
@@ -47,6 +38,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "Run-time configuration options for Apache Warble (incubating)")
     parser.add_argument('--version', action = 'store_true', help = 'Print node version and exit')
     parser.add_argument('--test', action = 'store_true', help = 'Run debug unit tests')
+    parser.add_argument('--benchmark', action = 'store_true', help = 'Run micro-benchmarks and exit')
     parser.add_argument('--fingerprint', action = 'store_true', help = 'Print fingerprint and exit')
     parser.add_argument('--wait', action = 'store_true', help = 'Wait for node to be fully registered on server before continuing')
     parser.add_argument('--config', type = str, help = 'Load a specific configuration file')
@@ -57,6 +49,31 @@ if __name__ == "__main__":
         print(_VERSION)
         sys.exit(0)
     
+    # --fingerprint: print the cached fingerprint if the key hasn't changed since
+    import plugins.basics.misc
+    keypath = "%s/conf/privkey.pem" % basepath
+    if args.fingerprint:
+        fp = plugins.basics.misc.cachedFingerprint(keypath)
+        if fp:
+            print(fp)
+            sys.exit(0)
+    
+    import ruamel.yaml
+    import base64
+    
+    # Warble-specific libraries
+    import plugins.basics.certs
+    import plugins.basics.crypto
+    import plugins.basics.executor
+    import plugins.basics.ingest
+    import plugins.basics.master
+    import plugins.basics.ntp
+    import plugins.basics.scheduler
+    import plugins.basics.spool
+    import plugins.basics.uploader
+    import plugins.basics.workers
+    import plugins.tests
+    
     # Specific conf file to load?
     if args.config:
         if os.path.exists(args.config):
@@ -79,7 +96,6 @@ if __name__ == "__main__":
     # purposes. This requires read+write access to the conf/ dir. In
     # subsequent runs, we can just load the existing (registered) key.
     privkey = None
-    keypath = "%s/conf/privkey.pem" % basepath
 
     # If key exists, load it...
     if os.path.exists(keypath):
@@ -106,15 +122,28 @@ if __name__ == "__main__":
             sys.exit(-1)
         os.chmod(keypath, stat.S_IWUSR|stat.S_IREAD) # chmod 600, only user can read/write
         print("Key pair successfully generated and saved!")
+    fp = plugins.basics.misc.cachedFingerprint(keypath)
+    if not fp:
+        fp = plugins.basics.crypto.fingerprint(privkey.public_key())
+        plugins.basics.misc.saveFingerprint(keypath, fp)
     if args.fingerprint:
-        print(plugins.basics.crypto.fingerprint(privkey.public_key()))
+        print(fp)
         sys.exit(0)
     print("INFO: Starting Warble node software, version %s" % _VERSION)
     
+    # Benchmark mode?
+    if args.benchmark:
+        import plugins.basics.benchmark
+        gconf['version'] = _VERSION
+        sys.exit(0 if plugins.basics.benchmark.run(gconf) else -1)
+    
     # Unit test mode?
     if args.test:
         print("Testing crypto library")
         plugins.basics.crypto.test()
+        print("Testing content matcher")
+        import plugins.basics.matcher
+        plugins.basics.matcher.test()
                         
         print("Running unit tests...")
         import plugins.basics.unittests
@@ -124,7 +153,11 @@ if __name__ == "__main__":
     
     
     
+    # Set node software version for tests and master requests
+    gconf['version'] = _VERSION
+    
     serverurl = gconf['client'].get('server')
+    master = plugins.basics.master.client(gconf)
     
     # If no api key has been retrieved yet, get one
     if gconf['client'].get('apikey', 'UNSET') == 'UNSET':
@@ -133,7 +166,7 @@ if __name__ == "__main__":
             sys.exit(-1)
         print("Uninitialized node, trying to register and fetch API key from %s" % serverurl)
         try:
-            rv = requests.post('%s/api/node/register' % serverurl, json = {
+            rv = master.post('/api/node/register', json = {
                 'version': _VERSION,
                 'hostname': hostname,
                 'pubkey': str(plugins.basics.crypto.pem(privkey.public_key()), 'ascii')
@@ -144,9 +177,10 @@ if __name__ == "__main__":
                 if payload['encrypted']:
                     apikey = str(plugins.basics.crypto.decrypt(privkey, base64.b64decode(apikey)), 'ascii')
                 print("INFO: Fetched API key %s from server" % apikey)
-                print("INFO: Registered with fingerprint: %s" % plugins.basics.crypto.fingerprint(privkey.public_key()))
+                print("INFO: Registered with fingerprint: %s" % fp)
                 print("INFO: Please verify that the node request has this fingerprint when verifying the node.")
                 gconf['client']['apikey'] = apikey
+                master.setkey(apikey)
                 # Save updated changes to disk
                 yaml.dump(gconf, open(configpath, "w"))
             else:
@@ -163,7 +197,7 @@ if __name__ == "__main__":
     # If --wait is passed, we'll pause and retry until we get our way.
     print("INFO: Checking for node eligibility...")
     while True:
-        rv = requests.get('%s/api/node/status' % serverurl, headers = {'APIKey': apikey})
+        rv = master.get('/api/node/status')
         if rv.status_code == 200:
             payload = rv.json()
             if payload.get('enabled'):
@@ -180,32 +214,86 @@ if __name__ == "__main__":
             print(rv.text)
             sys.exit(-1)
             
+    # Get local time offset from NTP
+    ntp = plugins.basics.ntp.estimator(gconf['misc']['ntpserver'], interval = gconf['misc'].get('ntpinterval', 900))
+    toffset = plugins.basics.misc.adjustTime(ntp)
+    gconf['misc']['offset'] = toffset
+    
+    # Certificates seen in earlier runs, so HTTPS checks don't have to parse them again
+    cconf = gconf.setdefault('certs', {})
+    cconf.setdefault('path', "%s/conf/certs.json" % basepath)
+    plugins.basics.certs.shared.open(cconf['path'])
+    
+    # Set up the scheduler first, so tasks can start running while the
+    # rest of the task list is still coming in.
+    econf = gconf.get('executor', {})
+    executor = plugins.basics.executor.executor(gconf, workers = econf.get('workers', 64), pertarget = econf.get('pertarget', 4), maxpending = econf.get('maxpending', 256))
+    uconf = gconf.get('uploader', {})
+    sconf = gconf.get('spool', {})
+    spool = plugins.basics.spool.spool(sconf.get('path', "%s/spool" % basepath), maxsize = sconf.get('maxsize', 256) * 1024 * 1024)
+    uploader = plugins.basics.uploader.uploader(gconf, master, privkey, batch = uconf.get('batch', 500), interval = uconf.get('interval', 5000), spool = spool, signing = uconf.get('signing', 'payload'))
+    uploader.start()
+    processes = econf.get('processes', 1)
+    if processes > 1:
+        # Split the tasks across worker processes, each with its own scheduler and executor
+        scheduler = plugins.basics.workers.pool(gconf, uploader.put, processes = processes, workers = max(1, executor.workers // processes),
+                                                pertarget = executor.pertarget, grouper = executor.group)
+    else:
+        scheduler = plugins.basics.scheduler.scheduler(gconf, lambda task: executor.submit(task, uploader.add),
+                                                       grouper = executor.group, batch = lambda tasks: executor.submitgroup(tasks, uploader.add),
+                                                       backlog = executor.lag)
+    scheduler.start()
+    
+    # Keep the time offset up to date while we run
+    def setoffset(offset):
+        gconf['misc']['offset'] = offset
+        plugins.basics.misc.toffset = offset
+        if processes > 1:
+            scheduler.setoffset(offset)
+    ntp.start(setoffset)
+    
     ## Get tasks to perform
     print("INFO: Fetching tasks to perform")
-    rv = requests.get('%s/api/node/tasks' % serverurl, headers = {'APIKey': apikey})
+    rv = master.get('/api/node/tasks', stream = True)
     if rv.status_code == 200:
-        # Decrypt or die trying
+        # Decode, decrypt and parse the task list as it streams in, or die trying
         try:
-            plain = plugins.basics.crypto.decrypt(privkey, base64.b64decode(rv.text))
-        except:
-            print("ALERT: Could not retrieve task data from Warble master due to an encryption error.")
+            print("Got the following tasks:")
+            def announce(tasks):
+                for task in tasks:
+                    print("- %04u: %s" % (task['id'], task['name']))
+                    yield task
+            scheduler.update(announce(plugins.basics.ingest.tasks(rv.iter_content(chunk_size = 16384), privkey)))
+        except Exception as err:
+            print("ALERT: Could not retrieve task data from Warble master due to an encryption or parsing error: %s" % err)
             sys.exit(-1)
-        # All good, load json payload and process!
-        payload = json.loads(plain.decode('utf-8'))
-        print("Got the following tasks:")
-        for task in payload['tasks']:
-            print("- %04u: %s" % (task['id'], task['name']))
     else:
         print("ALERT: Got status %u from warble master!" % rv.status_code)
         print(rv.text)
         sys.exit(-1)
-
-    # Set node software version for tests
-    gconf['version'] = _VERSION
-    
-    # Get local time offset from NTP
-    toffset = plugins.basics.misc.adjustTime(gconf['misc']['ntpserver'])
-    gconf['misc']['offset'] = toffset
-    
-    
+    if gconf.get('debug', False) == True:
+        print("INFO: Loaded test plugins: %s" % ", ".join("%s (%.1fms)" % (k, v * 1000) for k, v in sorted(plugins.tests.shared.stats().items())))
+    print("INFO: Scheduled %u tasks (%u workers in %u processes, max %u per target)" % (len(scheduler), executor.workers, processes, executor.pertarget))
     
+    # Keep an eye on the scheduler, warn if we can't keep up
+    while True:
+        time.sleep(60)
+        plugins.basics.certs.shared.maybesave()
+        lag = scheduler.lag()
+        if lag['average'] > 1:
+            print("WARNING: Checks are starting %.2f seconds late (max %.2f, %u runs skipped), node may be overloaded!" % (lag['average'], lag['max'], lag['skipped']))
+        ustats = uploader.stats()
+        if ustats['queued'] > uploader.batch * 10:
+            print("WARNING: %(queued)u results waiting to be uploaded (%(failures)u failed uploads, %(dropped)u results dropped)" % ustats)
+        if ustats['spool']:
+            print("WARNING: Master unreachable, %(spooled)u results spooled to disk so far (%(spool)u bytes pending)" % ustats)
+        if gconf.get('debug', False) == True:
+            print("INFO: Master connections: %(opened)u opened, %(reused)u reused for %(requests)u requests" % master.stats())
+            print("INFO: Clock offset %.3fms (+/- %.3fms, drifting %.2f ppm)" % (ntp.offset() * 1000, (ntp.uncertainty() or 0) * 1000, ntp.drift * 1e6))
+            if processes == 1:
+                print("INFO: Executor: %(inflight)u checks in flight, %(pending)u waiting for a slot, %(coalesced)u runs coalesced, %(rejected)u rejected" % executor.stats())
+            print("INFO: Uploader: %(queued)u queued, %(sent)u sent in %(batches)u batches, flush latency %(avglatency).3fs" % ustats)
+            print("INFO: Certificate inventory: %(entries)u certificates, %(hits)u hits, %(misses)u parsed" % plugins.basics.certs.shared.stats())
+            if processes > 1:
+                for wstats in scheduler.stats():
+                    print("INFO: Worker %(worker)u (pid %(pid)s): %(tasks)u tasks, %(rate).1f results/s, %(dropped)u dropped, %(restarts)u restarts" % wstats)
@@ -1,9 +1,19 @@
-import plugins.basics.socket
-import plugins.basics.misc
-import plugins.basics.crypto
+# The basic libraries are imported on first use rather than here, so that
+# importing one of them (or just the package) doesn't drag in all the rest,
+# and quick commands like node.py --version don't pay for them.
+import importlib
 
 __all__ = [
     'misc',
     'socket'
 ]
 
+def __getattr__(name):
+    if name.startswith('_'):
+        raise AttributeError(name)
+    try:
+        return importlib.import_module('plugins.basics.' + name)
+    except ModuleNotFoundError as err:
+        if err.name != 'plugins.basics.' + name:
+            raise
+        raise AttributeError("module 'plugins.basics' has no attribute '%s'" % name)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the micro-benchmark suite for Apache Warble (incubating)
+    nodes, run with node.py --benchmark. It times the hot paths of the
+    node on this machine, so changes to them can be compared.
+"""
+
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+
+import plugins.basics.misc
+import plugins.reports.generic
+
+class classic:
+    """ The original dict and list based report, as a baseline """
+    def __init__(self, globalConfig):
+        self._debug = []
+        self._warn = []
+        self._alert = []
+        self._error = None
+        self.timeseries = {}
+        self.details = {}
+        self.id = uuid.uuid4()
+        self.config = globalConfig
+        self.offset = globalConfig['misc'].get('offset', 0)
+    def debug(self, string, *args):
+        self._debug.append( (time.time() - self.offset, string % args if args else string) )
+    def note(self, key, value):
+        self.details[key] = value
+    def timer(self, tag):
+        self.timeseries[tag] = time.time() - self.offset
+    def dumps(self, **extra):
+        data = {
+            'id': str(self.id),
+            'error': self._error,
+            'timeseries': self.timeseries,
+            'details': self.details,
+            'warnings': self._warn,
+            'alerts': self._alert,
+            'debug': self._debug,
+        }
+        data.update(extra)
+        return json.dumps(data, separators = (',', ':')).encode('utf-8')
+
+def probe(report):
+    """ Fills in a report the way a typical TCP check does """
+    report.debug("Initialising socket")
+    report.timer('init')
+    report.debug("Looking up hostname %s...", 'www.example.org')
+    report.timer('dns')
+    report.debug("Connecting to %s:%u", '192.0.2.1', 443)
+    report.timer('connect')
+    report.note('family', 'ipv4')
+    report.note('address', '192.0.2.1')
+    report.timer('data')
+    report.debug("All went well, closing socket.")
+    report.timer('end')
+    return report
+
+def reports(gconf, n = 100000):
+    """ Measures construction, memory and serialization cost per report """
+    results = {}
+    for name, cls in ( ('classic', classic), ('compact', plugins.reports.generic.template) ):
+        gc.collect()
+        started = time.perf_counter()
+        for i in range(n):
+            probe(cls(gconf))
+        build = (time.perf_counter() - started) / n
+        gc.collect()
+        tracemalloc.start()
+        kept = [probe(cls(gconf)) for i in range(n // 10)]
+        memory = tracemalloc.get_traced_memory()[0] / len(kept)
+        tracemalloc.stop()
+        started = time.perf_counter()
+        for i, report in enumerate(kept):
+            report.dumps(task = i)
+        dump = (time.perf_counter() - started) / len(kept)
+        del kept
+        results[name] = (build, memory, dump)
+        print("%-8s: %6.2f us to build, %6u bytes each, %6.2f us to serialize" % (name, build * 1e6, memory, dump * 1e6))
+    return results
+
+def signing(gconf, batch = 500, single = 50):
+    """ Compares signing reports one by one with signing a batch of them
+        through a Merkle tree, in results signed per second """
+    import plugins.basics.crypto
+    key = plugins.basics.crypto.keypair()
+    items = [probe(plugins.reports.generic.template(gconf)).dumps(task = i) for i in range(batch)]
+    started = time.perf_counter()
+    for item in items[:single]:
+        plugins.basics.crypto.sign(key, str(item, 'utf-8'))
+    each = single / (time.perf_counter() - started)
+    started = time.perf_counter()
+    root, sig, proofs = plugins.basics.crypto.signbatch(key, items)
+    merkle = batch / (time.perf_counter() - started)
+    started = time.perf_counter()
+    assert all(plugins.basics.crypto.verifybatch(key.public_key(), sig, root, items, proofs))
+    verified = batch / (time.perf_counter() - started)
+    print("%-8s: %9.0f results/s" % ('single', each))
+    print("%-8s: %9.0f results/s (batches of %u, %.0fx), %.0f results/s verified" % ('merkle', merkle, batch, merkle / each, verified))
+    return each, merkle
+
+def decryption(size = 200000):
+    """ Times decrypting a legacy chunked RSA message one block at a time
+        and spread over all cores """
+    import plugins.basics.crypto
+    key = plugins.basics.crypto.keypair()
+    etxt = plugins.basics.crypto.encrypt(key.public_key(), os.urandom(size), legacy = True)
+    results = {}
+    for threads in sorted(set( (1, os.cpu_count() or 1) )):
+        started = time.perf_counter()
+        results[threads] = plugins.basics.crypto.decrypt(key, etxt, threads = threads)
+        elapsed = time.perf_counter() - started
+        print("%-8s: %6.1f ms for %u KB (%u thread%s)" % ('legacy', elapsed * 1000, size // 1024, threads, "" if threads == 1 else "s"))
+    assert len(set(results.values())) == 1
+    return results
+
+def matching(counts = (8, 32, 128, 192, 512, 2048), size = 1 << 20):
+    """ Times the content matcher looking for literals that aren't there,
+        one by one with find() and with the automaton, in ms per MB of body """
+    import random
+    import plugins.basics.matcher
+    rnd = random.Random(42)
+    body = bytes(rnd.choice(b"abcdefghijklmnopqrstuvwxyz <>/=\"") for i in range(size))
+    chunks = [body[i:i+16384] for i in range(0, size, 16384)]
+    results = {}
+    for count in counts:
+        literals = [b"needle %u %08x" % (i, rnd.getrandbits(32)) for i in range(count)]
+        elapsed = []
+        for automaton in (None, plugins.basics.matcher.compile(tuple(literals))):
+            m = plugins.basics.matcher.matcher(contains = literals)
+            m.automaton = automaton
+            started = time.perf_counter()
+            for chunk in chunks:
+                m.feed(chunk)
+            elapsed.append((time.perf_counter() - started) * 1000 / (size / (1 << 20)))
+        results[count] = tuple(elapsed)
+        print("%5u literals: %8.1f ms/MB with find, %6.1f ms/MB with the automaton%s" % (count, elapsed[0], elapsed[1], " (used)" if count >= plugins.basics.matcher.MANY else ""))
+    return results
+
+def coldstart(argv, runs = 5):
+    """ Returns the fastest of a few cold runs of a command, in seconds """
+    best = None
+    for i in range(runs):
+        started = time.perf_counter()
+        subprocess.run(argv, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = True)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def slowest(argv, n = 5):
+    """ Returns the n top level imports that took the longest for a command, as (us, module) """
+    rv = subprocess.run([sys.executable, '-X', 'importtime'] + argv, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, text = True)
+    imports = []
+    for line in rv.stderr.splitlines():
+        parts = line.split('|')
+        # Top level imports are the ones that aren't indented
+        if len(parts) == 3 and parts[1].strip().isdigit() and not parts[2].startswith('  '):
+            imports.append( (int(parts[1]), parts[2].strip()) )
+    return sorted(imports, reverse = True)[:n]
+
+def startup(limit = 0.1):
+    """ Times node.py --version and --fingerprint against a bare interpreter.
+        Returns False if either takes more than limit seconds on top of it. """
+    node = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), 'node.py')
+    keypath = os.path.join(os.path.dirname(node), 'conf', 'privkey.pem')
+    baseline = coldstart([sys.executable, '-c', 'pass'])
+    print("%-14s: %6.1f ms" % ('interpreter', baseline * 1000))
+    commands = [ ['--version'] ]
+    # Without a cached fingerprint, --fingerprint would have to load (or even make) the key
+    if plugins.basics.misc.cachedFingerprint(keypath):
+        commands.append( ['--fingerprint'] )
+    else:
+        print("%-14s: skipped, no cached fingerprint" % '--fingerprint')
+    ok = True
+    for args in commands:
+        elapsed = coldstart([sys.executable, node] + args) - baseline
+        print("%-14s: %6.1f ms on top of that" % (args[0], elapsed * 1000))
+        if elapsed > limit:
+            ok = False
+            print("ALERT: %s takes longer than %u ms, slowest imports:" % (args[0], limit * 1000))
+            for us, module in slowest([node] + args):
+                print("    %8.1f ms %s" % (us / 1000, module))
+    return ok
+
+def run(gconf):
+    """ Runs all benchmarks, returns False if any of them regressed """
+    gconf.setdefault('misc', {})
+    gconf['debug'] = False
+    print("Report objects:")
+    reports(gconf)
+    print("Signing:")
+    signing(gconf)
+    print("Decryption:")
+    decryption()
+    print("Content matching:")
+    matching()
+    print("Cold start:")
+    return startup(gconf.get('benchmark', {}).get('startup', 100) / 1000)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the certificate inventory for Apache Warble (incubating)
+    nodes. Most HTTPS checks see the same certificate as last time, so
+    certificates are parsed once and remembered by their sha256
+    fingerprint: subject, issuer, validity period and chain. Repeat
+    checks only hash the DER bytes and look the rest up. The inventory
+    is kept on disk across runs, and merged with what other worker
+    processes wrote when saved.
+"""
+
+import calendar
+import hashlib
+import json
+import os
+import ssl
+import threading
+import time
+
+def describe(name):
+    """ Turns a subject or issuer (as returned by getpeercert) into O=/OU=/CN= form """
+    fields = {}
+    for rdn in name or ():
+        for key, value in rdn:
+            fields.setdefault(key.lower(), value)
+    return "O=%s/OU=%s/CN=%s" % (fields.get('organizationname', "Unknown"), fields.get('organizationalunitname', "Unknown"), fields.get('commonname', "Unknown"))
+
+def parse(der, cert = None):
+    """ Parses a certificate into an inventory entry. Uses the dict from
+        getpeercert() if we have one (verified connections), otherwise
+        decodes the DER bytes. """
+    if cert:
+        subject = cert.get('subject', ())
+        issuer = cert.get('issuer', ())
+        names = [x[1] for x in cert.get('subjectAltName', ()) if x[0].lower() == 'dns']
+        notbefore = ssl.cert_time_to_seconds(cert['notBefore']) if 'notBefore' in cert else None
+        notafter = ssl.cert_time_to_seconds(cert['notAfter'])
+    else:
+        # Unverified connections don't get a parsed certificate from ssl, so we do it ourselves
+        import cryptography.x509
+        from cryptography.x509.oid import NameOID
+        x509 = cryptography.x509.load_der_x509_certificate(der)
+        def rdns(name):
+            return [[(label, attr.value)] for oid, label in ( (NameOID.ORGANIZATION_NAME, 'organizationName'),
+                                                              (NameOID.ORGANIZATIONAL_UNIT_NAME, 'organizationalUnitName'),
+                                                              (NameOID.COMMON_NAME, 'commonName') )
+                    for attr in name.get_attributes_for_oid(oid)]
+        subject = rdns(x509.subject)
+        issuer = rdns(x509.issuer)
+        try:
+            names = x509.extensions.get_extension_for_class(cryptography.x509.SubjectAlternativeName).value.get_values_for_type(cryptography.x509.DNSName)
+        except cryptography.x509.ExtensionNotFound:
+            names = []
+        notbefore = calendar.timegm((getattr(x509, 'not_valid_before_utc', None) or x509.not_valid_before).timetuple())
+        notafter = calendar.timegm((getattr(x509, 'not_valid_after_utc', None) or x509.not_valid_after).timetuple())
+    # Like browsers, prefer the first DNS name over the common name
+    if names:
+        subject = [rdn for rdn in subject if rdn[0][0].lower() != 'commonname'] + [[('commonName', names[0])]]
+    return {
+        'subject': describe(subject),
+        'issuer': describe(issuer),
+        'names': names,
+        'notbefore': notbefore,
+        'notafter': notafter,
+    }
+
+class inventory():
+    def __init__(self, path = None, maxentries = 10000, interval = 300):
+        self.path = path # Where to keep the inventory between runs, if anywhere
+        self.maxentries = maxentries
+        self.interval = interval # Seconds between saves
+        self.lock = threading.Lock()
+        self.savelock = threading.Lock()
+        self.entries = {} # sha256 fingerprint -> entry
+        self.dirty = False
+        self.lastsave = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    def open(self, path):
+        """ Loads the inventory from disk, and saves it there from now on """
+        self.path = path
+        entries = self._read()
+        with self.lock:
+            self.entries.update(entries)
+            self._trim()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def lookup(self, sslsock):
+        """ Returns (fingerprint, entry) for the peer certificate of a TLS
+            socket, parsing it only if we haven't seen it before """
+        der = sslsock.getpeercert(binary_form = True)
+        if not der:
+            return None, None
+        fp = hashlib.sha256(der).hexdigest()
+        now = int(time.time())
+        with self.lock:
+            entry = self.entries.get(fp)
+            if entry:
+                self.hits += 1
+                entry['lastseen'] = now
+                return fp, entry
+        entry = parse(der, sslsock.getpeercert(binary_form = False))
+        chain = getattr(sslsock, 'get_unverified_chain', None) # Python 3.13+
+        entry['chain'] = [hashlib.sha256(x if isinstance(x, bytes) else x.public_bytes()).hexdigest() for x in chain()[1:]] if chain else []
+        entry['firstseen'] = now
+        entry['lastseen'] = now
+        with self.lock:
+            self.misses += 1
+            self.entries[fp] = entry
+            self._trim()
+            self.dirty = True
+        self.maybesave()
+        return fp, entry
+
+    def expiry(self, entry, now = None):
+        """ Returns the number of seconds until a certificate expires (negative if it has) """
+        return entry['notafter'] - (time.time() if now is None else now)
+
+    def maybesave(self):
+        """ Saves the inventory if it has changed and the last save was long enough ago """
+        with self.lock:
+            due = self.path and self.dirty and time.monotonic() - self.lastsave > self.interval
+            if due:
+                self.lastsave = time.monotonic() # Keep other threads from saving too
+        if due:
+            self.save()
+
+    def _trim(self):
+        """ Forgets the certificates we haven't seen for the longest, beyond maxentries """
+        if len(self.entries) == self.maxentries + 1:
+            del self.entries[min(self.entries, key = lambda k: self.entries[k]['lastseen'])]
+        elif len(self.entries) > self.maxentries:
+            keep = sorted(self.entries, key = lambda k: self.entries[k]['lastseen'])[-self.maxentries:]
+            self.entries = {fp: self.entries[fp] for fp in keep}
+
+    def save(self):
+        """ Writes the inventory to disk, merged with anything other processes wrote there """
+        if not self.path:
+            return
+        # One save at a time, the file is read and written outside the lock probes use
+        with self.savelock:
+            ondisk = self._read()
+            with self.lock:
+                self.dirty = False
+                self.lastsave = time.monotonic()
+                for fp, entry in ondisk.items():
+                    if fp not in self.entries or self.entries[fp]['lastseen'] < entry.get('lastseen', 0):
+                        self.entries[fp] = entry
+                self._trim()
+                data = json.dumps(self.entries)
+            tmp = "%s.%u.%u.tmp" % (self.path, os.getpid(), threading.get_ident())
+            try:
+                with open(tmp, "w") as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except OSError as err:
+                print("WARNING: Could not save certificate inventory to %s: %s" % (self.path, err))
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+# Shared certificate inventory for all probes on this node
+shared = inventory()
+
+def test():
+    """ Tests for the certificate inventory """
+    import datetime
+    import tempfile
+    import cryptography.hazmat.primitives.asymmetric.ec
+    import cryptography.hazmat.primitives.hashes
+    import cryptography.hazmat.primitives.serialization
+    import cryptography.x509
+    from cryptography.x509.oid import NameOID
+    # A self-signed certificate, as an unverified connection would see it
+    key = cryptography.hazmat.primitives.asymmetric.ec.generate_private_key(cryptography.hazmat.primitives.asymmetric.ec.SECP256R1())
+    name = cryptography.x509.Name([cryptography.x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Warble"), cryptography.x509.NameAttribute(NameOID.COMMON_NAME, "warble.example")])
+    x509 = cryptography.x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(1).not_valid_before(datetime.datetime(2020, 1, 1)).not_valid_after(datetime.datetime(2030, 1, 1)) \
+        .add_extension(cryptography.x509.SubjectAlternativeName([cryptography.x509.DNSName("www.warble.example")]), critical = False) \
+        .sign(key, cryptography.hazmat.primitives.hashes.SHA256())
+    der = x509.public_bytes(cryptography.hazmat.primitives.serialization.Encoding.DER)
+    entry = parse(der)
+    assert(entry['subject'] == "O=Warble/OU=Unknown/CN=www.warble.example")
+    assert(entry['issuer'] == "O=Warble/OU=Unknown/CN=warble.example")
+    assert(entry['names'] == ["www.warble.example"] and entry['notafter'] == calendar.timegm((2030, 1, 1, 0, 0, 0)))
+    # The same, as getpeercert() has it on a verified connection
+    cert = {'subject': ((('organizationName', "Warble"),), (('commonName', "warble.example"),)), 'issuer': ((('commonName', "Some CA"),),),
+            'subjectAltName': (('DNS', "www.warble.example"),), 'notBefore': "Jan  1 00:00:00 2020 GMT", 'notAfter': "Jan  1 00:00:00 2030 GMT"}
+    assert(parse(der, cert)['subject'] == entry['subject'] and parse(der, cert)['notafter'] == entry['notafter'])
+    class sslsock():
+        def __init__(self, der):
+            self.der = der
+        def getpeercert(self, binary_form = False):
+            return self.der if binary_form else None
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "certs.json")
+        # Certificates are parsed once, and the least recently seen go first
+        inv = inventory(path, maxentries = 2, interval = 0)
+        fp, first = inv.lookup(sslsock(der))
+        assert(fp == hashlib.sha256(der).hexdigest() and first['subject'] == entry['subject'])
+        assert(inv.lookup(sslsock(der)) == (fp, first) and inv.stats()['hits'] == 1)
+        entries = dict(inv.entries)
+        for fake in ("a", "b"):
+            inv.entries[fake] = dict(first, lastseen = first['lastseen'] + 1)
+        inv._trim()
+        assert(set(inv.entries) == {"a", "b"})
+        # Saves merge with what other processes wrote, newest sighting wins
+        inv.entries = entries
+        inv.save()
+        other = inventory(maxentries = 10)
+        other.entries["c"] = dict(first, lastseen = 1)
+        other.open(path)
+        assert(set(other.entries) == {fp, "c"})
+        other.save()
+        inv.save()
+        assert(set(json.load(open(path))) == {fp, "c"})
+        # Saving from several threads at once doesn't lose or mangle anything
+        threads = [threading.Thread(target = inv.save) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert(set(json.load(open(path))) == {fp, "c"} and os.listdir(tmp) == ["certs.json"])
+    print("Certificate inventory works as intended!")
@@ -31,7 +31,12 @@ import cryptography.hazmat.primitives.asymmetric.rsa
 import cryptography.hazmat.primitives.asymmetric.utils
 import cryptography.hazmat.primitives.asymmetric.padding
 import cryptography.hazmat.primitives.hashes
+import cryptography.hazmat.primitives.ciphers.aead
+import concurrent.futures
 import hashlib
+import os
+import struct
+import threading
 
 def keypair(bits = 4096):
     """ Generate a private+public key pair for encryption/signing """
@@ -97,52 +102,198 @@ def fingerprint(key):
     sha = hashlib.sha224(_pem).hexdigest()
     return sha
 
-def decrypt(key, text):
-    """ Decrypt a message encrypted with the public key, by using the private key on-disk """
-    retval = b""
-    i = 0
-    txtl = len(text)
-    ks = int(key.key_size / 8) # bits -> bytes, room for padding
-    # Process the data in chunks the size of the key, as per the encryption
-    # model used below.
-    while i < txtl:
-        chunk = text[i:i+ks]
-        i += ks
-        ciphertext = key.decrypt(
-            chunk,
-            cryptography.hazmat.primitives.asymmetric.padding.OAEP(
-                mgf=cryptography.hazmat.primitives.asymmetric.padding.MGF1(
-                    algorithm=cryptography.hazmat.primitives.hashes.SHA1()
-                    ),
-                algorithm=cryptography.hazmat.primitives.hashes.SHA1(),
-                label=None
-            )
-        )
-        retval += ciphertext
+# Versioned envelope format: the body is encrypted with a random AES-256-GCM
+# key, and only that key is encrypted with RSA, once per message. The body is
+# split into independently sealed segments, so it can be decrypted (and
+# authenticated) as it streams in, without having the whole message at hand.
+#
+#   magic (4) | version (1) | wrapped key length (2) | RSA-OAEP wrapped AES key | nonce prefix (7)
+#   segment* : flags+length (4) | AES-GCM ciphertext+tag
+#
+# The segment header has the high bit set on the final segment, and both the
+# segment counter and the final flag go into the nonce, so segments cannot be
+# reordered, dropped or truncated without the decryption failing.
+#
+# Legacy messages have no header at all, so one could start with the magic
+# by chance. It only counts as an envelope if the version is one we know,
+# the wrapped key is exactly as long as our RSA key and it unwraps; anything
+# else is decrypted as a legacy message.
+ENVELOPE_MAGIC = b'WRB\x02'
+ENVELOPE_VERSION = 1
+ENVELOPE_HEADER = struct.Struct('!4sBH') # magic, version, wrapped key length
+ENVELOPE_SEGMENT = 65536
+ENVELOPE_FINAL = 0x80000000
+
+def _oaep():
+    return cryptography.hazmat.primitives.asymmetric.padding.OAEP(
+        mgf=cryptography.hazmat.primitives.asymmetric.padding.MGF1(
+            algorithm=cryptography.hazmat.primitives.hashes.SHA1()
+            ),
+        algorithm=cryptography.hazmat.primitives.hashes.SHA1(),
+        label=None
+    )
+
+def _nonce(prefix, counter, final):
+    return prefix + struct.pack('!IB', counter, 1 if final else 0)
+
+# Legacy RSA blocks are independent of each other, and the RSA backend lets
+# go of the GIL while decrypting, so large legacy messages are spread over
+# a thread pool shared by all decryptors.
+_pool = None
+_poollock = threading.Lock()
+
+def _workers():
+    global _pool
+    with _poollock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(max_workers = os.cpu_count() or 1, thread_name_prefix = 'warble-rsa')
+        return _pool
+
+class decryptor():
+    """ Incremental decryptor for both the envelope and the legacy chunked
+        format. Feed it ciphertext with update() as it arrives, and it hands
+        back whatever plaintext is complete (and authenticated) so far.
+        Legacy blocks are decrypted by up to threads threads at once
+        (one per CPU by default, 1 to decrypt them one by one). """
+    def __init__(self, key, threads = None):
+        self.key = key
+        self.threads = threads or os.cpu_count() or 1
+        self.ks = int(key.key_size / 8)
+        self.buffer = bytearray()
+        self.mode = None # None until we have seen enough bytes to tell, then 'envelope' or 'legacy'
+        self.aes = None
+        self.prefix = None
+        self.counter = 0
+        self.done = False
+
+    def update(self, data):
+        """ Adds ciphertext, returns the plaintext decrypted so far """
+        self.buffer += data
+        if self.mode is None:
+            if len(self.buffer) < ENVELOPE_HEADER.size:
+                return b""
+            magic, version, kl = ENVELOPE_HEADER.unpack_from(self.buffer)
+            self.mode = 'envelope' if magic == ENVELOPE_MAGIC and version == ENVELOPE_VERSION and kl == self.ks else 'legacy'
+        if self.mode == 'legacy':
+            return self._legacy()
+        return self._envelope()
+
+    def finalize(self):
+        """ Returns any remaining plaintext, raises if the message was cut short """
+        if self.mode != 'envelope':
+            if self.buffer:
+                raise ValueError("Truncated ciphertext: %u trailing bytes" % len(self.buffer))
+            return b""
+        if not self.done:
+            raise ValueError("Truncated envelope: final segment missing")
+        return b""
+
+    def _blocks(self, view, start, end):
+        """ Decrypts the legacy blocks between two offsets """
+        return b"".join([self.key.decrypt(bytes(view[i:i+self.ks]), _oaep()) for i in range(start, end, self.ks)])
+
+    def _legacy(self):
+        n = len(self.buffer) - len(self.buffer) % self.ks
+        blocks = n // self.ks
+        threads = min(self.threads, blocks)
+        view = memoryview(self.buffer)
+        if threads > 1:
+            # One run of consecutive blocks per thread, joined in order
+            per = -(-blocks // threads) * self.ks
+            out = b"".join(_workers().map(lambda start: self._blocks(view, start, min(start + per, n)), range(0, n, per)))
+        else:
+            out = self._blocks(view, 0, n)
+        view.release()
+        del self.buffer[:n]
+        return out
+
+    def _envelope(self):
+        out = []
+        view = memoryview(self.buffer)
+        i = 0
+        if self.aes is None:
+            hl = ENVELOPE_HEADER.size + self.ks
+            if len(view) < hl + 7:
+                view.release()
+                return b""
+            try:
+                aeskey = self.key.decrypt(bytes(view[ENVELOPE_HEADER.size:hl]), _oaep())
+                self.aes = cryptography.hazmat.primitives.ciphers.aead.AESGCM(aeskey)
+            except ValueError:
+                # Not ours to unwrap, so a legacy message that happens to look like an envelope
+                view.release()
+                self.mode = 'legacy'
+                return self._legacy()
+            self.prefix = bytes(view[hl:hl+7])
+            i = hl + 7
+        while len(view) - i >= 4:
+            if self.done:
+                raise ValueError("Trailing data after final envelope segment")
+            flags = struct.unpack('!I', view[i:i+4])[0]
+            final = bool(flags & ENVELOPE_FINAL)
+            sl = flags & ~ENVELOPE_FINAL
+            if sl > ENVELOPE_SEGMENT + 16 or sl < 16:
+                raise ValueError("Invalid envelope segment length %u" % sl)
+            if len(view) - i - 4 < sl:
+                break
+            out.append(self.aes.decrypt(_nonce(self.prefix, self.counter, final), bytes(view[i+4:i+4+sl]), None))
+            self.counter += 1
+            self.done = final
+            i += 4 + sl
+        view.release()
+        del self.buffer[:i]
+        return b"".join(out)
+
+def decrypt(key, text, threads = None):
+    """ Decrypt a message encrypted with the public key, by using the private key on-disk.
+        Handles both the envelope format and the legacy chunked RSA format. """
+    d = decryptor(key, threads = threads)
+    retval = d.update(text)
+    d.finalize()
     return retval
 
-def encrypt(key, text):
-    """ Encrypt a message using the public key, for decryption with the private key """
-    retval = b""
+def encrypt(key, text, legacy = False):
+    """ Encrypt a message using the public key, for decryption with the private key.
+        Uses the envelope format unless legacy is set, in which case the data is
+        encrypted in key-sized RSA chunks for masters that predate the envelope. """
+    if type(text) is str:
+        text = text.encode('utf-8')
+    if legacy:
+        return encrypt_legacy(key, text)
+    aeskey = cryptography.hazmat.primitives.ciphers.aead.AESGCM.generate_key(bit_length = 256)
+    aes = cryptography.hazmat.primitives.ciphers.aead.AESGCM(aeskey)
+    prefix = os.urandom(7)
+    wrapped = key.encrypt(aeskey, _oaep())
+    retval = [ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, len(wrapped)), wrapped, prefix]
+    view = memoryview(text)
+    txtl = len(text)
+    i = 0
+    counter = 0
+    while True:
+        final = i + ENVELOPE_SEGMENT >= txtl
+        ciphertext = aes.encrypt(_nonce(prefix, counter, final), view[i:i+ENVELOPE_SEGMENT], None)
+        retval.append(struct.pack('!I', len(ciphertext) | (ENVELOPE_FINAL if final else 0)))
+        retval.append(ciphertext)
+        if final:
+            break
+        i += ENVELOPE_SEGMENT
+        counter += 1
+    return b"".join(retval)
+
+def encrypt_legacy(key, text):
+    """ Encrypt a message in the legacy chunked RSA format """
+    if type(text) is str:
+        text = text.encode('utf-8')
+    retval = []
     i = 0
     txtl = len(text)
     ks = int(key.key_size / 8) - 64 # bits -> bytes, room for padding
     # Process data in chunks no larger than the key, leave some room for padding.
     while i < txtl:
         chunk = text[i:i+ks-1]
-        i += ks
-        ciphertext = key.encrypt(
-            chunk.encode('utf-8'),
-            cryptography.hazmat.primitives.asymmetric.padding.OAEP(
-                mgf=cryptography.hazmat.primitives.asymmetric.padding.MGF1(
-                    algorithm=cryptography.hazmat.primitives.hashes.SHA1()
-                    ),
-                algorithm=cryptography.hazmat.primitives.hashes.SHA1(),
-                label=None
-            )
-        )
-        retval += ciphertext
-    return retval
+        i += ks - 1
+        retval.append(key.encrypt(chunk, _oaep()))
+    return b"".join(retval)
 
 
 def sign(key, text):
@@ -195,6 +346,81 @@ def verify(key, sig, text):
     except cryptography.exceptions.InvalidSignature as err:
         return False
 
+# Batch signing: the reports in a batch are the leaves of a Merkle tree, and
+# only the root is signed. Each report comes with the sibling hashes on its
+# way up to the root (an inclusion proof), so a single report can be checked
+# against the one signature without the rest of the batch. Leaves and inner
+# nodes are hashed with different prefixes, so one can't pass for the other.
+MERKLE_LEAF = b'\x00'
+MERKLE_NODE = b'\x01'
+
+def _pss_root():
+    return cryptography.hazmat.primitives.asymmetric.padding.PSS(
+        mgf=cryptography.hazmat.primitives.asymmetric.padding.MGF1(cryptography.hazmat.primitives.hashes.SHA256()),
+        salt_length=cryptography.hazmat.primitives.asymmetric.padding.PSS.MAX_LENGTH
+    )
+
+def merkle(items):
+    """ Builds a Merkle tree over a list of byte strings. Returns its levels,
+        leaf hashes first and the root (alone) last. An odd node out is
+        carried up to the next level as is. """
+    level = [hashlib.sha256(MERKLE_LEAF + item).digest() for item in items] or [hashlib.sha256(b"").digest()]
+    levels = [level]
+    while len(level) > 1:
+        level = [hashlib.sha256(MERKLE_NODE + level[i] + level[i+1]).digest() if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+def inclusion(levels, index):
+    """ Returns the inclusion proof for leaf number index: the sibling hashes
+        from the leaf up, as hex prefixed with 'l' or 'r' for the side they go on """
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(('l' if sibling < index else 'r') + level[sibling].hex())
+        index >>= 1
+    return proof
+
+def merkleroot(item, proof):
+    """ Works out the Merkle root from an item and its inclusion proof """
+    digest = hashlib.sha256(MERKLE_LEAF + item).digest()
+    for step in proof:
+        sibling = bytes.fromhex(step[1:])
+        if step[0] == 'l':
+            digest = hashlib.sha256(MERKLE_NODE + sibling + digest).digest()
+        else:
+            digest = hashlib.sha256(MERKLE_NODE + digest + sibling).digest()
+    return digest
+
+def signbatch(key, items):
+    """ Signs a list of byte strings with a single signature over their Merkle root.
+        Returns (root, signature, list of inclusion proofs) """
+    levels = merkle(items)
+    root = levels[-1][0]
+    sig = key.sign(root, _pss_root(), cryptography.hazmat.primitives.asymmetric.utils.Prehashed(cryptography.hazmat.primitives.hashes.SHA256()))
+    return root, sig, [inclusion(levels, i) for i in range(len(items))]
+
+def verifyroot(key, sig, root):
+    """ Verifies the signature of a Merkle root using the public key """
+    try:
+        key.verify(sig, root, _pss_root(), cryptography.hazmat.primitives.asymmetric.utils.Prehashed(cryptography.hazmat.primitives.hashes.SHA256()))
+        return True
+    except cryptography.exceptions.InvalidSignature as err:
+        return False
+
+def verifyresult(key, sig, root, item, proof):
+    """ Verifies a single item of a signed batch, given its inclusion proof """
+    return merkleroot(item, proof) == root and verifyroot(key, sig, root)
+
+def verifybatch(key, sig, root, items, proofs):
+    """ Verifies a signed batch, checking the signature only once. Returns
+        a list of True/False, one for each item. A batch with a proof
+        missing (or one too many) is rejected as a whole. """
+    if len(items) != len(proofs) or not verifyroot(key, sig, root):
+        return [False] * len(items)
+    return [merkleroot(item, proof) == root for item, proof in zip(items, proofs)]
+
 def test():
     """ Tests for the crypto lib """
     
@@ -210,11 +436,63 @@ def test():
     dtxt = decrypt(privkey, etxt)
     assert(mystring == str(dtxt, 'utf-8'))
     
+    # Test the legacy chunked format, and a multi-segment envelope fed byte by byte
+    assert(mystring == str(decrypt(privkey, encrypt(pubkey, mystring, legacy = True)), 'utf-8'))
+    etxt = encrypt(pubkey, mystring * 100, legacy = True)
+    assert(decrypt(privkey, etxt, threads = 4) == decrypt(privkey, etxt, threads = 1))
+    bigstring = mystring * 5000
+    etxt = encrypt(pubkey, bigstring)
+    d = decryptor(privkey)
+    dtxt = b"".join(d.update(etxt[i:i+1000]) for i in range(0, len(etxt), 1000)) + d.finalize()
+    assert(bigstring == str(dtxt, 'utf-8'))
+    d = decryptor(privkey)
+    etxt = encrypt(pubkey, mystring)
+    assert(b"".join(d.update(etxt[i:i+1]) for i in range(len(etxt))) + d.finalize() == mystring.encode('utf-8'))
+    
+    # Anything that isn't quite an envelope of ours is taken for a legacy message, and fails as one:
+    # an unknown version, a key of the wrong size, a wrapped key that doesn't unwrap
+    header = ENVELOPE_HEADER.size
+    etxt = encrypt(pubkey, mystring)
+    for bad in (etxt[:4] + b"\x09" + etxt[5:], encrypt(keypair(2048).public_key(), mystring), etxt[:header] + bytes(16) + etxt[header+16:]):
+        d = decryptor(privkey)
+        try:
+            d.update(bad)
+            d.finalize()
+            assert(False)
+        except ValueError:
+            assert(d.mode == 'legacy')
+    # A real envelope cut short is just that
+    try:
+        decrypt(privkey, etxt[:header+100])
+        assert(False)
+    except ValueError as err:
+        assert('Truncated envelope' in str(err))
+    # Segment lengths are sanity checked, rather than waited for
+    etxt = encrypt(pubkey, mystring)
+    hl = header + privkey.key_size // 8 + 7
+    try:
+        decrypt(privkey, etxt[:hl] + struct.pack('!I', 0x7FFFFFFF) + etxt[hl+4:])
+        assert(False)
+    except ValueError as err:
+        assert('segment length' in str(err))
+    
     # Test signing
     xx = sign(privkey, mystring)
     
     # Test verification
     assert( verify(pubkey, xx, mystring))
     
+    # Test batch signing, with an odd number of items so one gets carried up a level
+    items = [b"result %u" % i for i in range(7)]
+    root, sig, proofs = signbatch(privkey, items)
+    assert(all(verifybatch(pubkey, sig, root, items, proofs)))
+    assert(verifyresult(pubkey, sig, root, items[6], proofs[6]))
+    assert(not verifyresult(pubkey, sig, root, items[5], proofs[6]))
+    assert(not any(verifybatch(pubkey, sig, hashlib.sha256(b"").digest(), items, proofs)))
+    # Items without a proof, or proofs without an item, don't get waved through
+    assert(verifybatch(pubkey, sig, root, items, proofs[:-1]) == [False] * 7)
+    assert(verifybatch(pubkey, sig, root, items[:-1], proofs) == [False] * 6)
+    assert(verifybatch(pubkey, sig, root, items + [b"extra"], proofs + [proofs[0]]) == [True] * 7 + [False])
+    
     print("Crypto lib works as intended!")
 
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the concurrent task executor for Apache Warble (incubating)
+    nodes. It runs the tests handed to us by the master on a bounded
+    pool of worker threads, with an additional limit on how many checks
+    may run against the same target (host+port) at any given time.
+    Tasks that would exceed the per-target limit are parked in a
+    per-target queue and started as soon as a slot frees up, so they
+    never hold on to a worker thread while waiting. A task that comes due
+    again while its previous run is still waiting to start isn't queued
+    a second time.
+"""
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+import plugins.tests
+
+class executor():
+    def __init__(self, globalConfig, workers = 64, pertarget = 4, maxpending = 256):
+        self.config = globalConfig
+        self.workers = workers
+        self.pertarget = pertarget
+        self.maxpending = maxpending # Most tasks waiting for a slot per target, beyond that they are turned away
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'warble-probe')
+        self.lock = threading.Lock()
+        self.running = collections.Counter() # target -> checks in flight
+        self.pending = {} # target -> deque of (task, callback, future, time submitted) waiting for a slot
+        self.inflight = 0
+        self.idle = threading.Condition(self.lock)
+        self.waiting = {} # task id (tuple of ids for groups) -> future, until the task starts
+        self.coalesced = 0 # Runs dropped because the previous one hadn't started yet
+        self.rejected = 0 # Runs turned away because their target had too many waiting already
+        # How long tasks wait between being submitted and starting, in seconds
+        self.lastwait = 0.0
+        self.avgwait = 0.0
+        self.maxwait = 0.0
+
+    def target(self, task):
+        """ Returns the (host, port) tuple a task (or group of tasks) is aimed at """
+        if isinstance(task, list):
+            task = task[0]
+        return (task.get('host'), int(task.get('port', 80)))
+
+    def key(self, task):
+        """ Returns what identifies a task (or group) across runs, or None if nothing does """
+        if isinstance(task, list):
+            ids = tuple(x.get('id') for x in task)
+            return None if None in ids else ids
+        return task.get('id')
+
+    def group(self, task):
+        """ Returns the key of the group of tasks this task can be run together
+            with (such as HTTP checks sharing a connection), or None """
+        try:
+            module = plugins.tests.shared.get(task.get('type', 'tcp'))
+        except Exception:
+            return None # Unknown types fail when they run, not when scheduled
+        if hasattr(module, 'groupkey'):
+            return module.groupkey(task)
+        return None
+
+    def submit(self, task, callback = None):
+        """ Queues a task for execution, returns a future resolving to the test object """
+        target = self.target(task)
+        key = self.key(task)
+        queued = time.monotonic()
+        with self.lock:
+            if key is not None and key in self.waiting:
+                self.coalesced += 1
+                return self.waiting[key]
+            queue = self.pending.get(target)
+            if queue is not None and len(queue) >= self.maxpending:
+                self.rejected += 1
+                future = concurrent.futures.Future()
+                future.set_exception(Exception("Too many checks waiting for %s:%u" % target))
+                return future
+            if key is not None:
+                future = self.waiting[key] = concurrent.futures.Future()
+            else:
+                future = concurrent.futures.Future()
+            self.inflight += 1
+            if self.running[target] < self.pertarget:
+                self.running[target] += 1
+                self.pool.submit(self._execute, task, callback, future, queued)
+            else:
+                self.pending.setdefault(target, collections.deque()).append( (task, callback, future, queued) )
+        return future
+
+    def submitgroup(self, tasks, callback = None):
+        """ Queues a group of tasks (with the same group key) to be run together
+            in one slot, returns a future resolving to a list of test objects """
+        return self.submit(list(tasks), callback)
+
+    def run(self, tasks, callback = None):
+        """ Runs a list of tasks and waits for all of them to complete.
+            Returns the test objects of every task that could be started. """
+        futures = [self.submit(task, callback) for task in tasks]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as err:
+                print("ALERT: %s" % err)
+        return results
+
+    def wait(self, timeout = None):
+        """ Waits until no more tasks are queued or running """
+        with self.idle:
+            return self.idle.wait_for(lambda: self.inflight == 0, timeout)
+
+    def shutdown(self, wait = True):
+        self.pool.shutdown(wait = wait)
+
+    def lag(self):
+        """ Returns how long tasks wait for a worker or a target slot before they start, in seconds """
+        return {
+            'last': self.lastwait,
+            'average': self.avgwait,
+            'max': self.maxwait,
+            'skipped': self.coalesced + self.rejected,
+        }
+
+    def stats(self):
+        """ Returns how many tasks are running and waiting, and how many runs were dropped """
+        with self.lock:
+            return {
+                'inflight': self.inflight,
+                'pending': sum(len(x) for x in self.pending.values()),
+                'targets': len(self.running),
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+            }
+
+    def _execute(self, task, callback, future, queued):
+        """ Runs a single task on a worker thread, then hands its slot on """
+        t = None
+        wait = time.monotonic() - queued
+        key = self.key(task)
+        with self.lock:
+            if key is not None and self.waiting.get(key) is future:
+                del self.waiting[key]
+            self.lastwait = wait
+            self.avgwait = 0.9 * self.avgwait + 0.1 * wait
+            self.maxwait = max(self.maxwait, wait)
+        try:
+            if isinstance(task, list):
+                future.set_result(self._executegroup(task, callback))
+                return
+            ttype = task.get('type', 'tcp')
+            try:
+                module = plugins.tests.shared.get(ttype)
+            except Exception as err:
+                raise Exception("%s for task %s" % (err, task.get('id')))
+            t = module.test(self.config)
+            try:
+                t.run(task)
+            except Exception as err:
+                t.report.error('executor', str(err))
+            if callback:
+                callback(task, t)
+            future.set_result(t)
+        except Exception as err:
+            future.set_exception(err)
+        finally:
+            self._release(self.target(task))
+
+    def _executegroup(self, tasks, callback):
+        """ Runs a group of tasks through their test module's runmany() """
+        ttype = tasks[0].get('type', 'tcp')
+        tests = plugins.tests.shared.get(ttype).runmany(self.config, tasks, pipeline = tasks[0].get('pipeline', False) == True)
+        if callback:
+            for task, t in zip(tasks, tests):
+                callback(task, t)
+        return tests
+
+    def _release(self, target):
+        """ Frees up a target slot, starting the next queued task for it if any """
+        with self.lock:
+            self.inflight -= 1
+            queue = self.pending.get(target)
+            if queue:
+                task, callback, future, queued = queue.popleft()
+                if not queue:
+                    del self.pending[target]
+                self.pool.submit(self._execute, task, callback, future, queued)
+            else:
+                self.running[target] -= 1
+                if not self.running[target]:
+                    del self.running[target]
+            if self.inflight == 0:
+                self.idle.notify_all()
+
+def test():
+    """ Tests for the executor: per-target limits, coalescing and the pending bound """
+    import types
+    gate = threading.Event()
+    class probe():
+        def __init__(self, globalConfig):
+            self.report = None
+        def run(self, task):
+            gate.wait(5)
+    plugins.tests.shared.modules['selftest'] = types.SimpleNamespace(test = probe)
+    try:
+        e = executor({'misc': {}}, workers = 4, pertarget = 1, maxpending = 2)
+        task = lambda i: {'id': i, 'type': 'selftest', 'host': 'example.org', 'port': 80}
+        first = e.submit(task(1)) # Runs straight away
+        queued = e.submit(task(2)) # Waits for the slot
+        assert(e.submit(task(2)) is queued) # Still waiting, so not queued twice
+        e.submit(task(3))
+        try:
+            e.submit(task(4)).result(0)
+            assert(False)
+        except Exception as err:
+            assert("Too many checks" in str(err))
+        stats = e.stats()
+        assert(stats['inflight'] == 3 and stats['pending'] == 2)
+        assert(stats['coalesced'] == 1 and stats['rejected'] == 1)
+        gate.set()
+        assert(e.wait(5))
+        assert(queued.result(0) is not None and e.lag()['skipped'] == 2)
+        e.shutdown()
+    finally:
+        del plugins.tests.shared.modules['selftest']
+    print("Executor works as intended!")
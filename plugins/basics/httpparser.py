@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the incremental HTTP/1.1 response parser for Apache Warble
+    (incubating) nodes. It is a byte-level state machine: feed it data
+    as it comes off the socket, and it works out the status line, the
+    headers we care about and where the body ends (Content-Length,
+    chunked transfer encoding or connection close), firing timers at
+    the exact chunk where the first byte, the end of the headers and the
+    end of the body show up. The header block is kept as one buffer and
+    the few headers we need are looked up in it directly, instead of
+    splitting and decoding every header line. Like most clients, we take
+    a bare LF for a CRLF, as some servers still send those.
+"""
+
+import re
+
+# End of the header block: an empty line, with or without CRs
+HEADEREND = re.compile(rb'\r?\n\r?\n')
+
+# Parser states
+STATUS = 0 # Reading status line and headers
+LENGTH = 1 # Reading a body of known length
+CHUNKSIZE = 2 # Reading a chunk size line
+CHUNKDATA = 3 # Reading chunk data
+CHUNKEND = 4 # Reading the CRLF after chunk data
+TRAILERS = 5 # Reading trailers after the last chunk
+UNTILCLOSE = 6 # Reading a body that ends when the connection closes
+DONE = 7
+
+class response():
+    def __init__(self, method = 'GET', limit = None, timer = None, body = None, maxheader = 65536):
+        self.method = method.upper()
+        self.limit = limit # Stop after this many body bytes, if set
+        self.timer = timer # Called with 'read', 'headers' and 'data' as those points are reached
+        self.body = body # Called with each piece of body data (a memoryview, only valid during the call)
+        self.maxheader = maxheader
+        self.state = STATUS
+        self.head = bytearray() # Status line and headers
+        self.scanned = 0 # Where to resume looking for the end of the headers
+        self.line = bytearray() # Partial chunk size/trailer line
+        self.remaining = 0 # Bytes left of the current body/chunk
+        self.started = False
+        # What we found out
+        self.version = None
+        self.status = None
+        self.statusline = None
+        self.reason = None
+        self.server = None
+        self.location = None
+        self.length = None
+        self.chunked = False
+        self.keepalive = False
+        self.bodybytes = 0
+        self.truncated = False
+
+    @property
+    def done(self):
+        return self.state == DONE
+
+    @property
+    def ready(self):
+        """ True once the status line and headers have been parsed """
+        return self.state != STATUS
+
+    def _header(self, lower, name):
+        """ Finds a header value in the (lowercased) header block, or None """
+        i = lower.find(b'\n' + name + b':')
+        if i < 0:
+            return None
+        i += len(name) + 2
+        j = lower.find(b'\n', i)
+        if j < 0:
+            j = len(lower)
+        return bytes(self.head[i:j]).strip()
+
+    def _headers(self):
+        """ Parses the complete status line and header block """
+        eol = self.head.find(b'\n')
+        if eol < 0:
+            eol = len(self.head)
+        self.statusline = str(self.head[:eol], 'iso-8859-1').rstrip('\r')
+        parts = self.statusline.split(' ', 2)
+        if len(parts) < 2 or not parts[0].upper().startswith('HTTP/') or not parts[1].isdigit():
+            raise ValueError("Invalid HTTP response received: " + self.statusline)
+        self.version = parts[0].upper()
+        self.status = int(parts[1])
+        self.reason = parts[2] if len(parts) > 2 else ""
+        lower = bytes(self.head).lower()
+        server = self._header(lower, b'server')
+        if server is not None:
+            self.server = str(server, 'iso-8859-1')
+        location = self._header(lower, b'location')
+        if location is not None:
+            self.location = str(location, 'iso-8859-1')
+        te = self._header(lower, b'transfer-encoding')
+        cl = self._header(lower, b'content-length')
+        conn = self._header(lower, b'connection')
+        if self.version == 'HTTP/1.0':
+            self.keepalive = conn is not None and conn.lower() == b'keep-alive'
+        else:
+            self.keepalive = conn is None or conn.lower() != b'close'
+        # Interim responses (100 Continue etc) are followed by the real one
+        if 100 <= self.status < 200:
+            self.head = bytearray()
+            self.scanned = 0
+            return STATUS
+        if self.method == 'HEAD' or self.status in (204, 304):
+            self.length = 0
+            return DONE
+        if te is not None and te.lower().endswith(b'chunked'):
+            self.chunked = True
+            return CHUNKSIZE
+        if cl is not None:
+            try:
+                self.length = int(cl)
+            except ValueError:
+                raise ValueError("Invalid Content-Length: %s" % str(cl, 'iso-8859-1'))
+            self.remaining = self.length
+            return LENGTH if self.length else DONE
+        self.keepalive = False
+        return UNTILCLOSE
+
+    def _finish(self):
+        self.state = DONE
+        if self.timer:
+            self.timer('data')
+
+    def _data(self, view):
+        """ Passes on body data, up to our limit. Returns the number of bytes taken """
+        if self.limit is not None and len(view) > self.limit - self.bodybytes:
+            view = view[:self.limit - self.bodybytes]
+        self.bodybytes += len(view)
+        if self.body and len(view):
+            self.body(view)
+        return len(view)
+
+    def _full(self):
+        """ Returns True if we have read as much body as we were told to """
+        return self.limit is not None and self.bodybytes >= self.limit
+
+    def _readline(self, view, i):
+        """ Collects a (CR)LF terminated line from view, starting at i. Returns
+            (line or None if incomplete, new position) """
+        chunk = bytes(view[i:i+4096-len(self.line)])
+        j = chunk.find(b'\n')
+        if j < 0:
+            if len(self.line) + len(chunk) >= 4096:
+                raise ValueError("Chunk header line too long")
+            self.line += chunk
+            return None, i + len(chunk)
+        self.line += chunk[:j+1]
+        line = bytes(self.line).rstrip(b'\r\n')
+        self.line = bytearray()
+        return line, i + j + 1
+
+    def feed(self, data):
+        """ Parses as much of data as belongs to this response. Returns the
+            number of bytes consumed; anything past that belongs to the next
+            response on the connection. """
+        view = memoryview(data)
+        n = len(view)
+        i = 0
+        if n and not self.started:
+            self.started = True
+            if self.timer:
+                self.timer('read')
+        while i < n and self.state != DONE:
+            if self.state == STATUS:
+                before = len(self.head)
+                self.head += view[i:]
+                end = HEADEREND.search(self.head, self.scanned)
+                if end is None:
+                    if len(self.head) > self.maxheader:
+                        raise ValueError("Response headers larger than %u bytes" % self.maxheader)
+                    self.scanned = max(0, len(self.head) - 3)
+                    i = n
+                    break
+                # Give back whatever followed the headers
+                i += end.end() - before
+                del self.head[end.start():]
+                state = self._headers()
+                if state == STATUS:
+                    continue
+                if self.timer:
+                    self.timer('headers')
+                if state == DONE:
+                    self._finish()
+                else:
+                    self.state = state
+            elif self.state == LENGTH:
+                take = self._data(view[i:i+min(self.remaining, n - i)])
+                i += take
+                self.remaining -= take
+                if not self.remaining:
+                    self._finish()
+                elif self._full():
+                    self.truncated = True
+                    self._finish()
+            elif self.state == UNTILCLOSE:
+                i += self._data(view[i:])
+                if self._full():
+                    self.truncated = True
+                    self._finish()
+            elif self.state == CHUNKSIZE:
+                line, i = self._readline(view, i)
+                if line is None:
+                    break
+                size = line.split(b';', 1)[0].strip()
+                try:
+                    self.remaining = int(size, 16)
+                except ValueError:
+                    raise ValueError("Invalid chunk size: %s" % str(size, 'iso-8859-1'))
+                self.state = CHUNKDATA if self.remaining else TRAILERS
+            elif self.state == CHUNKDATA:
+                take = self._data(view[i:i+min(self.remaining, n - i)])
+                i += take
+                self.remaining -= take
+                if not self.remaining:
+                    self.state = CHUNKEND
+                elif self._full():
+                    self.truncated = True
+                    self._finish()
+            elif self.state == CHUNKEND:
+                line, i = self._readline(view, i)
+                if line is None:
+                    break
+                if line:
+                    raise ValueError("Missing CRLF after chunk data")
+                self.state = CHUNKSIZE
+            elif self.state == TRAILERS:
+                line, i = self._readline(view, i)
+                if line is None:
+                    break
+                if not line:
+                    self._finish()
+        if self.truncated:
+            self.keepalive = False
+        view.release()
+        return i
+
+    def eof(self):
+        """ Tells the parser the connection was closed. Raises if that cut the response short """
+        if self.state == UNTILCLOSE:
+            self._finish()
+        elif self.state != DONE:
+            if self.state == STATUS and not self.head:
+                raise ValueError("Connection closed without a response")
+            raise ValueError("Connection closed before the response was complete")
+
+def test():
+    """ Tests for the HTTP response parser, fed all at once and one byte at a time """
+    def parse(data, bytewise, **kwargs):
+        """ Returns the parser, the body and how much of data it consumed """
+        body = []
+        r = response(body = lambda view: body.append(bytes(view)), **kwargs)
+        i = 0
+        while i < len(data) and not r.done:
+            used = r.feed(data[i:i+1] if bytewise else data[i:])
+            i += used
+            if not bytewise or not used:
+                break
+        return r, b"".join(body), i
+    for bytewise in (False, True):
+        # Chunked body with a trailer, with the next response right behind it
+        data = b"HTTP/1.1 200 OK\r\nServer: test\r\nTransfer-Encoding: chunked\r\n\r\n" \
+               b"5;ext=1\r\nhello\r\n7\r\n, world\r\n0\r\nX-Trailer: yes\r\n\r\n"
+        r, body, used = parse(data + b"HTTP/1.1 204 No Content\r\n\r\n", bytewise)
+        assert(r.done and r.chunked and r.keepalive)
+        assert(body == b"hello, world" and used == len(data))
+        assert(r.status == 200 and r.server == 'test')
+        # Interim responses are skipped
+        data = b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 404 Not Found\r\nContent-Length: 3\r\n\r\nnopeleftover"
+        r, body, used = parse(data, bytewise)
+        assert(r.status == 404 and r.reason == 'Not Found' and body == b"nop" and data[used:] == b"eleftover")
+        # Bare LF line endings, and a HTTP/1.0 body that ends when the connection closes
+        data = b"HTTP/1.0 301 Moved\nLocation: http://example.org/\nServer: old\n\nmoved"
+        r, body, used = parse(data, bytewise)
+        assert(not r.done and r.location == 'http://example.org/' and r.server == 'old' and body == b"moved")
+        r.eof()
+        assert(r.done and not r.keepalive)
+        data = b"HTTP/1.1 200 OK\nTransfer-Encoding: chunked\n\n3\nabc\n0\n\n"
+        r, body, used = parse(data, bytewise)
+        assert(r.done and body == b"abc" and used == len(data))
+        # Body limit: we stop early and won't reuse the connection
+        data = b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n" + b"x" * 100
+        r, body, used = parse(data, bytewise, limit = 10)
+        assert(r.done and r.truncated and not r.keepalive and body == b"x" * 10)
+        # No body for HEAD requests, whatever the headers say
+        r, body, used = parse(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n", bytewise, method = 'head')
+        assert(r.done and r.length == 0 and body == b"")
+        # Oversized headers and garbage are errors
+        for data, kwargs in ((b"HTTP/1.1 200 OK\r\nX: " + b"y" * 200, {'maxheader': 100}), (b"SSH-2.0-OpenSSH\r\n\r\n", {})):
+            try:
+                parse(data, bytewise, **kwargs)
+                assert(False)
+            except ValueError:
+                pass
+        # A connection closed mid response is an error
+        r, body, used = parse(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort", bytewise)
+        try:
+            r.eof()
+            assert(False)
+        except ValueError:
+            pass
+    print("HTTP response parser works as intended!")
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the streaming task list reader for Apache Warble (incubating)
+    nodes. The task list from the master is base64 encoded, encrypted
+    JSON. Instead of decoding, decrypting and parsing it in one go, each
+    stage here works on whatever has arrived so far, so tasks are handed
+    on one at a time while the rest of the list is still in transit and
+    only a small window of the list is ever held in memory.
+"""
+
+import base64
+import binascii
+import codecs
+import json
+
+import plugins.basics.crypto
+
+class b64decoder():
+    """ Incremental base64 decoder, ignores whitespace between chunks """
+    def __init__(self):
+        self.buffer = b""
+
+    def update(self, data):
+        data = self.buffer + b"".join(data.split())
+        n = len(data) - len(data) % 4
+        self.buffer = data[n:]
+        return base64.b64decode(data[:n])
+
+    def finalize(self):
+        if self.buffer:
+            raise binascii.Error("Incomplete base64 data at end of stream")
+        return b""
+
+class jsontasks():
+    """ Incremental parser for a {"tasks": [...], ...} JSON document.
+        Feed it text with update(), and it returns every task object that
+        is complete so far. Other top-level keys are kept in self.meta. """
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.state = 'start' # start -> key -> colon -> value|tasks -> next -> end
+        self.key = None
+        self.meta = {}
+        self.seen = False # Whether we found the tasks array at all
+
+    def _skip(self):
+        """ Skips whitespace, returns the next character or None if we need more data """
+        while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+            self.pos += 1
+        return self.buffer[self.pos] if self.pos < len(self.buffer) else None
+
+    def _decode(self):
+        """ Decodes one JSON value at the current position, or returns (False, None)
+            if it isn't complete yet. A value must be followed by at least one more
+            character, so that a number cut short at the end of the buffer is not
+            mistaken for a complete one. """
+        try:
+            obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            return False, None
+        if end >= len(self.buffer):
+            return False, None
+        self.pos = end
+        return True, obj
+
+    def _expect(self, char):
+        c = self._skip()
+        if c is None:
+            return False
+        if c != char:
+            raise ValueError("Malformed task list: expected '%s' at offset %u, got '%s'" % (char, self.pos, c))
+        self.pos += 1
+        return True
+
+    def update(self, text):
+        """ Adds text to the parser, returns a list of complete tasks """
+        # Drop what we've already consumed every now and then, not on every call.
+        if self.pos > 65536:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += text
+        tasks = []
+        while True:
+            if self.state == 'start':
+                if not self._expect('{'):
+                    break
+                self.state = 'key'
+            elif self.state == 'key':
+                c = self._skip()
+                if c is None:
+                    break
+                if c == '}':
+                    self.pos += 1
+                    self.state = 'end'
+                    continue
+                done, key = self._decode()
+                if not done:
+                    break
+                self.key = key
+                self.state = 'colon'
+            elif self.state == 'colon':
+                if not self._expect(':'):
+                    break
+                self.state = 'value'
+            elif self.state == 'value':
+                if self.key == 'tasks':
+                    if not self._expect('['):
+                        break
+                    self.seen = True
+                    self.state = 'tasks'
+                    continue
+                c = self._skip()
+                if c is None:
+                    break
+                done, value = self._decode()
+                if not done:
+                    break
+                self.meta[self.key] = value
+                self.state = 'next'
+            elif self.state in ('tasks', 'tasksep'):
+                c = self._skip()
+                if c is None:
+                    break
+                if c == ']':
+                    self.pos += 1
+                    self.state = 'next'
+                    continue
+                if self.state == 'tasksep':
+                    if not self._expect(','):
+                        break
+                    self.state = 'tasks'
+                    continue
+                done, task = self._decode()
+                if not done:
+                    break
+                tasks.append(task)
+                self.state = 'tasksep'
+            elif self.state == 'next':
+                c = self._skip()
+                if c is None:
+                    break
+                self.pos += 1
+                if c == ',':
+                    self.state = 'key'
+                elif c == '}':
+                    self.state = 'end'
+                else:
+                    raise ValueError("Malformed task list: unexpected '%s' at offset %u" % (c, self.pos - 1))
+            elif self.state == 'end':
+                if self._skip() is not None:
+                    raise ValueError("Malformed task list: trailing data after end of document")
+                break
+        return tasks
+
+    def finalize(self):
+        """ Checks that the document was complete """
+        if self.state != 'end':
+            raise ValueError("Malformed task list: document ended prematurely")
+        if not self.seen:
+            raise ValueError("Malformed task list: no tasks array found")
+        return []
+
+def tasks(chunks, privkey):
+    """ Turns an iterable of raw (base64 encoded, encrypted) response body
+        chunks into a generator of task dicts """
+    b64 = b64decoder()
+    decryptor = plugins.basics.crypto.decryptor(privkey)
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    parser = jsontasks()
+    for chunk in chunks:
+        for task in parser.update(utf8.decode(decryptor.update(b64.update(chunk)))):
+            yield task
+    b64.finalize()
+    for task in parser.update(utf8.decode(decryptor.finalize(), final = True)):
+        yield task
+    parser.finalize()
+
+def test():
+    """ Tests for the streaming task list reader """
+    # Base64 split at awkward places, with line breaks in between
+    data = bytes(range(256)) * 3
+    text = base64.encodebytes(data)
+    for step in (1, 3, 77):
+        b64 = b64decoder()
+        assert(b"".join(b64.update(text[i:i+step]) for i in range(0, len(text), step)) + b64.finalize() == data)
+    b64 = b64decoder()
+    b64.update(b"QUJD RA")
+    try:
+        b64.finalize()
+        assert(False)
+    except binascii.Error:
+        pass
+    # Task list fed one character at a time, with numbers and strings cut short
+    doc = {'version': 12345, 'tasks': [{'id': i, 'name': "task \"%u\" ünïcode" % i, 'interval': 1.5 * i} for i in range(20)], 'sign': None}
+    text = json.dumps(doc, indent = 1)
+    parser = jsontasks()
+    got = []
+    for c in text:
+        got += parser.update(c)
+    parser.finalize()
+    assert(got == doc['tasks'])
+    assert(parser.meta == {'version': 12345, 'sign': None})
+    # Broken documents
+    for text in ('{"tasks": [{"id": 1}] x', '{"tasks": [{"id": 1} {"id": 2}]}', '{"version": 1} trailing', '[]'):
+        try:
+            jsontasks().update(text)
+            assert(False)
+        except ValueError:
+            pass
+    for text in ('{"tasks": [{"id": 1}', '{"version": 1}'):
+        parser = jsontasks()
+        parser.update(text)
+        try:
+            parser.finalize()
+            assert(False)
+        except ValueError:
+            pass
+    # The whole thing: base64 encoded, encrypted JSON in small chunks
+    privkey = plugins.basics.crypto.keypair(2048)
+    doc = {'tasks': [{'id': i, 'url': "https://example.org/%u" % i} for i in range(500)]}
+    for legacy in (False, True):
+        body = base64.b64encode(plugins.basics.crypto.encrypt(privkey.public_key(), json.dumps(doc), legacy = legacy))
+        assert(list(tasks((body[i:i+1000] for i in range(0, len(body), 1000)), privkey)) == doc['tasks'])
+    print("Task list reader works as intended!")
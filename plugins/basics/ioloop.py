@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the non-blocking I/O core for Apache Warble (incubating)
+    nodes. All sockets of all in-flight probes are watched by a single
+    selector (epoll, kqueue etc, whatever is best on this platform) on
+    one thread. A probe that needs to wait for its socket registers it
+    here and sleeps until the socket is ready or its timeout is up, so
+    there's no per-probe select() call and no FD_SETSIZE limit on how
+    many sockets can be in flight.
+"""
+
+import errno
+import os
+import selectors
+import socket
+import threading
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+class waiter():
+    """ A probe waiting for one or more of its sockets to become ready """
+    __slots__ = ('event', 'ready', 'socks')
+    def __init__(self, socks):
+        self.event = threading.Event()
+        self.ready = []
+        self.socks = socks
+
+class core():
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        # Socket pair for waking up the selector when registrations change
+        self.wakeup, self.wakeup_write = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.wakeup_write.setblocking(False)
+        self.selector.register(self.wakeup, EVENT_READ, None)
+        # epoll and kqueue pick up new registrations while waiting, the others need a nudge
+        self.nudge = isinstance(self.selector, (selectors.SelectSelector, getattr(selectors, 'PollSelector', selectors.SelectSelector)))
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target = self.loop, name = 'warble-io', daemon = True)
+                self.thread.start()
+
+    def _wake(self):
+        try:
+            self.wakeup_write.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass # Already a wakeup pending, that'll do
+
+    def loop(self):
+        while True:
+            events = self.selector.select()
+            with self.lock:
+                for key, mask in events:
+                    w = key.data
+                    if w is None:
+                        try:
+                            while self.wakeup.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        continue
+                    w.ready.append(key.fileobj)
+                for key, mask in events:
+                    w = key.data
+                    if w is not None and not w.event.is_set():
+                        self._unregister(w)
+                        w.event.set()
+
+    def _unregister(self, w):
+        for sock in w.socks:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    def wait(self, socks, events, timeout = None):
+        """ Waits for any of socks to become ready for events (EVENT_READ
+            and/or EVENT_WRITE). Returns the list of ready sockets, empty
+            if the timeout was reached first. """
+        if not isinstance(socks, (list, tuple)):
+            socks = [socks]
+        if not self.thread:
+            self.start()
+        w = waiter(socks)
+        with self.lock:
+            for sock in socks:
+                self.selector.register(sock, events, w)
+        if self.nudge:
+            self._wake()
+        w.event.wait(timeout)
+        with self.lock:
+            if not w.event.is_set():
+                self._unregister(w)
+                w.event.set()
+            return list(w.ready)
+
+    def connect(self, sock, address, timeout = None):
+        """ Connects a socket without blocking the thread on the kernel,
+            raises on failure or timeout """
+        sock.setblocking(False)
+        err = sock.connect_ex(address)
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            if not self.wait(sock, EVENT_WRITE, timeout):
+                raise socket.timeout("Connection timed out after %s seconds" % timeout)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise OSError(err, os.strerror(err))
+
+# Shared I/O core for all probes on this node
+shared = core()
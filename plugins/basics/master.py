@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the client library for talking to the Warble master from
+    Apache Warble (incubating) nodes. All node-to-master traffic goes
+    through a single keep-alive session, so we only pay for the TCP and
+    TLS handshakes once instead of on every request.
+"""
+
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+class client():
+    def __init__(self, globalConfig):
+        cconf = globalConfig['client']
+        self.server = cconf.get('server')
+        # (connect, read) timeouts in seconds
+        self.timeout = (cconf.get('connect_timeout', 5), cconf.get('read_timeout', 30))
+        retries = urllib3.util.retry.Retry(
+            total = cconf.get('retries', 3),
+            backoff_factor = cconf.get('backoff', 0.5),
+            status_forcelist = (502, 503, 504),
+            allowed_methods = ('GET', 'HEAD'), # POSTs aren't idempotent, only retry reads
+            raise_on_status = False,
+        )
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = cconf.get('pool', 4), max_retries = retries)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.session.headers['User-Agent'] = "Apache Warble/%s" % globalConfig.get('version', 'unknown')
+        apikey = cconf.get('apikey', 'UNSET')
+        if apikey != 'UNSET':
+            self.setkey(apikey)
+
+    def setkey(self, apikey):
+        """ Sets the API key sent along with every request """
+        self.session.headers['APIKey'] = apikey
+
+    def url(self, path):
+        return "%s%s" % (self.server, path)
+
+    def get(self, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(self.url(path), **kwargs)
+
+    def post(self, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(self.url(path), **kwargs)
+
+    def stats(self):
+        """ Returns the number of connections opened vs reused for requests """
+        opened = 0
+        requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                opened += pool.num_connections
+                requests += pool.num_requests
+        return {
+            'requests': requests,
+            'opened': opened,
+            'reused': max(0, requests - opened),
+        }
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the streaming content matcher for Apache Warble (incubating)
+    nodes. Response bodies are fed through it chunk by chunk as they come
+    off the wire, so content checks work on pages of any size without
+    keeping them in memory. Literal strings (must / must not contain)
+    are all searched for in a single pass with an Aho-Corasick automaton,
+    regular expressions are run over a sliding window, and the body can
+    be hashed (sha256) on the way through to tell when a page changed.
+    Once every check has been decided and no hash is wanted, the matcher
+    says so, and the caller can stop reading.
+
+    The automaton steps through the body a byte at a time in Python, while
+    bytes.find() runs at C speed, so up to a couple of hundred literals
+    are cheaper to look for one by one. The automaton only kicks in for
+    sets larger than that (node.py --benchmark measures the crossover).
+"""
+
+import functools
+import hashlib
+import re
+import time
+
+# Use Aho-Corasick from this many literal patterns on. Measured with
+# benchmark.matching(): per-literal find() costs ~0.3 ms per MB of body,
+# the automaton a flat ~45-65 ms per MB, so they break even at 150-200.
+MANY = 192
+
+class automaton():
+    """ Aho-Corasick automaton for finding any of a set of byte strings
+        in a stream, compiled into a flat 256-way transition table """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        goto = [{}]
+        outputs = [set()]
+        for n, pattern in enumerate(self.patterns):
+            state = 0
+            for b in pattern:
+                if b not in goto[state]:
+                    goto.append({})
+                    outputs.append(set())
+                    goto[state][b] = len(goto) - 1
+                state = goto[state][b]
+            outputs[state].add(n)
+        # Breadth first, fill in the failure transitions, so every state has a move for every byte
+        delta = [0] * (len(goto) * 256)
+        fail = [0] * len(goto)
+        queue = []
+        for b, state in goto[0].items():
+            delta[b] = state
+            queue.append(state)
+        while queue:
+            nextqueue = []
+            for state in queue:
+                outputs[state] |= outputs[fail[state]]
+                for b in range(256):
+                    target = goto[state].get(b)
+                    if target is None:
+                        delta[state << 8 | b] = delta[fail[state] << 8 | b]
+                    else:
+                        fail[target] = delta[fail[state] << 8 | b]
+                        delta[state << 8 | b] = target
+                        nextqueue.append(target)
+            queue = nextqueue
+        self.delta = delta
+        self.outputs = [frozenset(x) if x else None for x in outputs]
+
+    def feed(self, data, state = 0):
+        """ Scans more of the stream, starting from the state the previous
+            chunk left us in. Returns (new state, set of pattern numbers found) """
+        delta = self.delta
+        outputs = self.outputs
+        found = set()
+        for b in data:
+            state = delta[state << 8 | b]
+            if outputs[state] is not None:
+                found |= outputs[state]
+        return state, found
+
+@functools.lru_cache(maxsize = 256)
+def compile(patterns):
+    """ Returns the (shared) automaton for a tuple of patterns, building it on first use """
+    return automaton(patterns)
+
+class matcher():
+    def __init__(self, contains = (), excludes = (), regex = (), digest = False, window = 4096):
+        self.contains = [self._bytes(x) for x in contains] # Must all be in the body
+        self.excludes = [self._bytes(x) for x in excludes] # Must not be in the body
+        self.regex = [re.compile(self._bytes(x)) for x in regex] # Must all match somewhere in the body
+        self.window = window # Regex matches can't span more than this many bytes
+        self.literals = self.contains + self.excludes
+        self.automaton = compile(tuple(self.literals)) if len(self.literals) >= MANY else None
+        self.state = 0 # Where the automaton left off
+        self.overlap = b'' # End of the previous chunk, for literals spanning chunks (without automaton)
+        self.longest = max([len(x) for x in self.literals] or [0])
+        self.found = set() # Literals (by number) seen so far
+        self.matched = set() # Regexes (by number) matched so far
+        self.tail = b'' # End of the body so far, for regexes spanning chunks
+        self.hash = hashlib.sha256() if digest else None
+        self.bytes = 0
+        self.elapsed = 0 # ns spent matching
+
+    def _bytes(self, value):
+        return value.encode('utf-8') if isinstance(value, str) else bytes(value)
+
+    @property
+    def done(self):
+        """ True once reading more of the body can't change the outcome """
+        if self.hash:
+            return False
+        if any(len(self.contains) + i in self.found for i in range(len(self.excludes))):
+            return True # Failed already
+        if self.excludes:
+            return False # Only the end of the body can tell us an excluded string isn't there
+        return len(self.matched) == len(self.regex) and all(i in self.found for i in range(len(self.contains)))
+
+    def feed(self, data):
+        """ Runs a chunk of body data (bytes or memoryview) through the checks """
+        started = time.perf_counter_ns()
+        self.bytes += len(data)
+        if self.hash:
+            self.hash.update(data)
+        if len(self.found) < len(self.literals):
+            if self.automaton:
+                self.state, found = self.automaton.feed(data, self.state)
+                self.found |= found
+            else:
+                text = self.overlap + bytes(data)
+                for n, literal in enumerate(self.literals):
+                    if n not in self.found and text.find(literal) != -1:
+                        self.found.add(n)
+                self.overlap = text[-(self.longest - 1):] if self.longest > 1 else b''
+        if len(self.matched) < len(self.regex):
+            text = self.tail + bytes(data)
+            for n, regex in enumerate(self.regex):
+                if n not in self.matched and regex.search(text):
+                    self.matched.add(n)
+            self.tail = text[-self.window:]
+        self.elapsed += time.perf_counter_ns() - started
+
+    def failures(self):
+        """ Returns a list of human readable reasons the body failed the checks """
+        problems = []
+        for n, pattern in enumerate(self.contains):
+            if n not in self.found:
+                problems.append("Response body does not contain '%s'" % str(pattern, 'utf-8', errors = 'replace'))
+        for n, pattern in enumerate(self.excludes):
+            if len(self.contains) + n in self.found:
+                problems.append("Response body contains '%s'" % str(pattern, 'utf-8', errors = 'replace'))
+        for n, regex in enumerate(self.regex):
+            if n not in self.matched:
+                problems.append("Response body does not match /%s/" % str(regex.pattern, 'utf-8', errors = 'replace'))
+        return problems
+
+    def digest(self):
+        """ Returns the sha256 of the body read so far, if we were asked to make one """
+        return self.hash.hexdigest() if self.hash else None
+
+def test():
+    """ Tests for the content matcher """
+    for many in (False, True):
+        padding = [b"filler %u" % i for i in range(MANY)] if many else []
+        # An excluded string arriving after the wanted one must still be caught
+        m = matcher(contains = [b"ok"] + padding, excludes = [b"ERROR"])
+        assert(not m.done)
+        m.feed(b"all ok " + b" ".join(padding))
+        assert(not m.done)
+        m.feed(b"then an ERR")
+        m.feed(b"OR in a later chunk")
+        assert(m.done)
+        assert(m.failures() == ["Response body contains 'ERROR'"])
+        # With only excludes, we have to read the whole body
+        m = matcher(excludes = [b"ERROR"] + padding)
+        assert(not m.done)
+        m.feed(b"nothing to see here")
+        assert(not m.done and not m.failures())
+    # Contains and regexes alone are decided as soon as they are found
+    m = matcher(contains = ["needle"], regex = [r"id=\d+"])
+    m.feed(b"hay needle hay id=")
+    assert(not m.done)
+    m.feed(b"42")
+    assert(m.done and not m.failures())
+    print("Content matcher works as intended!")
@@ -20,68 +20,110 @@
 """
 
 # Socket imports
-import select
+import collections
+import os
 import socket
-import ssl
-import struct
-from socket import AF_INET, SOCK_DGRAM
 import time
 import uuid
 
+# NTP offset of the local clock, in seconds (set by adjustTime)
+toffset = 0
+
 def hostname():
     return socket.gethostname()
 
 def appid():
     return "%s/%s" % (hostname(), uuid.uuid4())
 
-def adjustTime(host):
-    TS_1970 = 2208988800
-    client = socket.socket( AF_INET, SOCK_DGRAM )
-    client.settimeout(5)
-    data = b'\x1b' + 47 * b'\0'
-    ipaddr = socket.gethostbyname(host)
-    client.sendto( data, ( ipaddr, 123 ))
+def fingerprintPath(keypath):
+    """ Returns where the cached fingerprint for a key file lives """
+    return os.path.splitext(keypath)[0] + ".fingerprint"
+
+def cachedFingerprint(keypath):
+    """ Returns the cached public key fingerprint for a key file, or None
+        if there is none or the key file has changed since it was made """
+    try:
+        st = os.stat(keypath)
+        with open(fingerprintPath(keypath)) as f:
+            fp, size, mtime = f.read().split()
+        if int(size) == st.st_size and int(mtime) == st.st_mtime_ns:
+            return fp
+    except (OSError, ValueError):
+        pass
+    return None
+
+def saveFingerprint(keypath, fp):
+    """ Caches the public key fingerprint for a key file next to it """
+    st = os.stat(keypath)
     try:
-        data, address = client.recvfrom( 1024 )
-        if data:
-            t = struct.unpack( '!12I', data )[10]
-            t -= TS_1970
-            offset = time.time() - t
-            if offset > 0:
-                print("NTP: Offsetting time by %d miliseconds (machine clock is slightly ahead of real time)" % (offset * 1000))
-            elif offset < 0:
-                print("NTP: Offsetting time by %d miliseconds (machine clock is slightly behind real time)" % (offset * 1000))
-            return offset
-        else:
-            return 0
-    except Exception as err:
-        return 0
+        with open(fingerprintPath(keypath), "w") as f:
+            f.write("%s %u %u\n" % (fp, st.st_size, st.st_mtime_ns))
+    except OSError as err:
+        print("WARNING: Could not cache key fingerprint: %s" % err)
+
+def adjustTime(host):
+    """ Works out the offset of the local clock from NTP, given the NTP
+        server(s) to ask or a plugins.basics.ntp.estimator. Returns the
+        offset in seconds, or the previous one if no server answered.
+        Only one query is sent per address, so as not to hold up startup;
+        the estimator's background thread follows up with a full round. """
+    global toffset
+    import plugins.basics.ntp
+    ntp = host if isinstance(host, plugins.basics.ntp.estimator) else plugins.basics.ntp.estimator(host)
+    result = ntp.estimate(samples = 1)
+    if result is None:
+        print("WARNING: No usable answers from NTP servers %s, not adjusting time" % ", ".join(ntp.servers))
+        return toffset
+    offset, error = result
+    if offset > 0:
+        print("NTP: Offsetting time by %.3f miliseconds (+/- %.3f, machine clock is slightly ahead of real time)" % (offset * 1000, error * 1000))
+    elif offset < 0:
+        print("NTP: Offsetting time by %.3f miliseconds (+/- %.3f, machine clock is slightly behind real time)" % (offset * 1000, error * 1000))
+    toffset = offset
+    return offset
 
 
 
 class timer():
     def __init__(self):
-        self.started = time.time() - toffset
-        self.last = time.time();
+        # One wall clock reading, everything after that is measured on the monotonic clock
+        self.anchor = time.time_ns() - int(toffset * 1e9)
+        self.base = time.perf_counter_ns()
+        self.started = self.anchor / 1e9
+        self.last = self.base
         self.log = {}
     def add(self, logtype):
-        self.log['time_' + logtype] = time.time() - toffset
-        if (time.time() - self.last) > 60:
+        now = time.perf_counter_ns()
+        self.log['time_' + logtype] = (self.anchor + now - self.base) / 1e9
+        if (now - self.last) > 60 * 1e9:
             raise Exception("Monitoring step took more than 60 seconds to complete")
-        self.last = time.time()
+        self.last = now
 
 class debugger():
-    def __init__(self):
+    """ Keeps the last few messages, formatting them only when they're looked at """
+    def __init__(self, size = 256, verbose = True):
         self.started = time.time()
-        self.log = ""
-    def add(self, message):
-        self.log += "[%s]: %s\r\n" % (time.asctime(time.gmtime()), message)
-        print("[%s]: %s\r\n" % (time.asctime(time.gmtime()), message))
+        self.entries = collections.deque(maxlen = size) # (timestamp, message, format args)
+        self.verbose = verbose
+    def add(self, message, *args):
+        now = time.time()
+        self.entries.append( (now, message, args) )
+        if self.verbose:
+            print("[%s]: %s\r\n" % (time.asctime(time.gmtime(now)), message % args if args else message))
+    @property
+    def log(self):
+        return "".join("[%s]: %s\r\n" % (time.asctime(time.gmtime(t)), message % args if args else message) for t, message, args in self.entries)
 
 
-def makeError(component, errmsg):
+def makeError(component, errmsg, clock = None):
+    """ Makes an error entry. Given a report or timer as clock, the time
+        comes off its monotonic clock, so it lines up with its timestamps """
     log = {}
-    log['time'] = time.time() - toffset
+    if clock is None:
+        clock = timer()
+    elapsed = time.perf_counter_ns() - clock.base
+    log['time'] = (clock.anchor + elapsed) / 1e9
+    log['elapsed'] = elapsed / 1000 # Microseconds since the clock started, like report durations
     log['component'] = component
     log['error'] = errmsg
     return log
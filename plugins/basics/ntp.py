@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the NTP clock offset estimator for Apache Warble (incubating)
+    nodes. It asks every address behind the configured NTP server(s) for
+    the time at once, a few times over, and works out the offset of our
+    clock from the full timestamps and round trip time of each answer.
+    The best sample per server is kept, servers that disagree with the
+    rest are thrown out, and the remaining ones are averaged, weighted by
+    how close they are. A background thread repeats this now and then,
+    and tracks how fast our clock drifts in between.
+    
+    Public servers (the NTP pool in particular) rate limit clients, so
+    queries to the same address are sent at least two seconds apart, and
+    a server that sends a kiss-o'-death is left alone for a while. Waiting
+    for that would hold up startup, so the first round can make do with
+    one query per address, and the background thread then does a full
+    round right away.
+
+    As elsewhere in Warble, the offset is local time minus real time, so
+    real time is time.time() - offset.
+"""
+
+import math
+import os
+import selectors
+import socket
+import statistics
+import struct
+import threading
+import time
+
+NTP_EPOCH = 2208988800 # Seconds from 1900 to 1970
+NTP_PACKET = struct.Struct('!BBbbII4sQQQQ')
+
+def fromntp(value):
+    """ Converts a 64 bit NTP timestamp to a unix timestamp in ns """
+    secs = value >> 32
+    if secs < 2**31: # Era 1, 2036 onwards
+        secs += 2**32
+    return (secs - NTP_EPOCH) * 1000000000 + ((value & 0xFFFFFFFF) * 1000000000 >> 32)
+
+class sample():
+    """ One answer from an NTP server """
+    __slots__ = ('server', 'offset', 'delay')
+    def __init__(self, server, offset, delay):
+        self.server = server
+        self.offset = offset # Local minus server time, seconds
+        self.delay = delay # Round trip time minus server processing time, seconds
+
+class estimator():
+    def __init__(self, servers, samples = 2, timeout = 2, interval = 900, step = 60, port = 123, spacing = 2, backoff = 3600):
+        if isinstance(servers, str):
+            servers = [x.strip() for x in servers.split(',') if x.strip()]
+        self.servers = servers
+        self.port = port
+        self.samples = samples # Queries per server address per round
+        self.timeout = timeout # Seconds to wait for answers after the last query
+        self.spacing = spacing # Seconds between queries to the same address
+        self.backoff = backoff # Seconds to leave a server alone after a kiss-o'-death
+        self.kissed = {} # address -> time.monotonic() until which we don't ask it
+        self.interval = interval # Seconds between rounds
+        self.step = step # Seconds between drift corrections in between rounds
+        self.lock = threading.Lock()
+        self.base = 0.0 # Offset at the last round
+        self.when = None # time.monotonic() of the last round
+        self.drift = 0.0 # Change of offset per second
+        self.error = None # Uncertainty of the last round, seconds
+        self.partial = False # Whether the last round asked fewer than self.samples times
+        self.listeners = []
+        self.thread = None
+        self.running = False
+        self.wakeup = threading.Event()
+
+    def addresses(self):
+        """ Returns every address behind our servers (pools have several) """
+        addresses = []
+        now = time.monotonic()
+        for server in self.servers:
+            try:
+                for info in socket.getaddrinfo(server, self.port, 0, socket.SOCK_DGRAM):
+                    if self.kissed.get(info[4][0], 0) > now:
+                        continue
+                    if info[4] not in [x[2] for x in addresses]:
+                        addresses.append( (server, info[0], info[4]) )
+            except socket.gaierror as err:
+                print("WARNING: Could not resolve NTP server %s: %s" % (server, err))
+        return addresses
+
+    def query(self, addresses, samples = None):
+        """ Asks all addresses for the time in parallel, returns the samples we got back """
+        samples = samples or self.samples
+        results = []
+        selector = selectors.DefaultSelector()
+        socks = []
+        sent = {} # (sock, our transmit timestamp) -> local send time in ns
+        try:
+            for server, family, address in addresses:
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+                sock.setblocking(False)
+                try:
+                    sock.connect(address)
+                except OSError:
+                    sock.close()
+                    continue
+                socks.append(sock)
+                selector.register(sock, selectors.EVENT_READ, address[0])
+            deadline = None
+            nextsend = time.monotonic()
+            rounds = 0
+            while socks:
+                now = time.monotonic()
+                if rounds < samples and now >= nextsend:
+                    for sock in socks:
+                        t1 = time.time_ns()
+                        # We put a random transmit timestamp in, and the server echoes it back to us
+                        tag = struct.unpack('!Q', os.urandom(8))[0]
+                        try:
+                            sock.send(NTP_PACKET.pack(0x23, 0, 0, 0, 0, 0, b'\0' * 4, 0, 0, 0, tag))
+                            sent[(sock, tag)] = t1
+                        except OSError:
+                            pass
+                    rounds += 1
+                    nextsend = now + self.spacing
+                    if rounds == samples:
+                        deadline = now + self.timeout
+                # Done once the last queries have been answered or timed out
+                if deadline is not None and (now >= deadline or not sent):
+                    break
+                wait = deadline - now if deadline is not None else max(0, nextsend - now)
+                for key, mask in selector.select(wait):
+                    try:
+                        data = key.fileobj.recv(1024)
+                    except OSError:
+                        continue
+                    t4 = time.time_ns()
+                    if len(data) < NTP_PACKET.size:
+                        continue
+                    flags, stratum, poll, precision, rootdelay, rootdisp, refid, ref, orig, recv, xmit = NTP_PACKET.unpack_from(data)
+                    t1 = sent.pop((key.fileobj, orig), None)
+                    if t1 is None:
+                        continue # Stray packet
+                    if stratum == 0:
+                        # Kiss-o'-death: the server wants us to go away (or slow down), so we do
+                        print("WARNING: NTP server %s sent kiss-o'-death %s, not asking it again for %u seconds" % (key.data, str(refid, 'ascii', errors = 'replace'), self.backoff))
+                        self.kissed[key.data] = time.monotonic() + self.backoff
+                        selector.unregister(key.fileobj)
+                        socks.remove(key.fileobj)
+                        key.fileobj.close()
+                        for k in [k for k in sent if k[0] is key.fileobj]:
+                            del sent[k]
+                        continue
+                    # Ignore unsynchronized servers
+                    if stratum >= 16 or flags >> 6 == 3 or not recv or not xmit:
+                        continue
+                    t2 = fromntp(recv)
+                    t3 = fromntp(xmit)
+                    offset = ((t1 - t2) + (t4 - t3)) / 2e9
+                    delay = max(0, (t4 - t1) - (t3 - t2)) / 1e9
+                    results.append(sample(key.data, offset, delay))
+        finally:
+            selector.close()
+            for sock in socks:
+                sock.close()
+        return results
+
+    def combine(self, samples):
+        """ Turns samples into (offset, uncertainty), or None if there's nothing usable """
+        # The answer with the shortest round trip is the most trustworthy one per server
+        best = {}
+        for s in samples:
+            if s.server not in best or s.delay < best[s.server].delay:
+                best[s.server] = s
+        best = list(best.values())
+        if not best:
+            return None
+        # Throw out servers that disagree with the majority
+        median = statistics.median(s.offset for s in best)
+        spread = statistics.median(abs(s.offset - median) for s in best)
+        kept = [s for s in best if abs(s.offset - median) <= max(3 * 1.4826 * spread, s.delay / 2, 0.001)]
+        # Weighted average, closer servers count more
+        weights = [1 / max(s.delay, 0.0001) ** 2 for s in kept]
+        offset = sum(w * s.offset for w, s in zip(weights, kept)) / sum(weights)
+        # Half the round trip bounds how wrong a single sample can be
+        error = min(s.delay for s in kept) / 2
+        if len(kept) > 1:
+            error = math.sqrt(error ** 2 + statistics.pstdev(s.offset for s in kept) ** 2)
+        return offset, error
+
+    def estimate(self, samples = None):
+        """ Does a round of queries and updates the offset, returns (offset, uncertainty) or None.
+            samples overrides how many times each address is asked this round. """
+        samples = samples or self.samples
+        result = self.combine(self.query(self.addresses(), samples))
+        if result is None:
+            return None
+        offset, error = result
+        now = time.monotonic()
+        with self.lock:
+            if self.when is not None and now - self.when > 60:
+                # Track drift, but don't let one noisy round throw it off
+                drift = (offset - self.base) / (now - self.when)
+                drift = max(-0.0005, min(0.0005, drift)) # 500 ppm is as bad as real clocks get
+                self.drift = drift if not self.drift else 0.7 * self.drift + 0.3 * drift
+            self.base = offset
+            self.when = now
+            self.error = error
+            self.partial = samples < self.samples
+        return offset, error
+
+    def offset(self):
+        """ Returns the current offset estimate, corrected for drift since the last round """
+        with self.lock:
+            if self.when is None:
+                return 0.0
+            return self.base + self.drift * (time.monotonic() - self.when)
+
+    def uncertainty(self):
+        """ Returns how far off the current offset may be, in seconds (None if we have no estimate) """
+        with self.lock:
+            if self.when is None:
+                return None
+            return self.error + abs(self.drift) * (time.monotonic() - self.when) / 2
+
+    def _publish(self):
+        offset = self.offset()
+        for listener in self.listeners:
+            try:
+                listener(offset)
+            except Exception as err:
+                print("ALERT: Could not update time offset: %s" % err)
+
+    def loop(self):
+        lastround = time.monotonic()
+        while self.running:
+            self.wakeup.wait(self.step)
+            if not self.running:
+                break
+            if self.partial or time.monotonic() - lastround >= self.interval:
+                lastround = time.monotonic()
+                try:
+                    if self.estimate() is None:
+                        print("WARNING: No usable answers from NTP servers %s, keeping the old time offset" % ", ".join(self.servers))
+                except Exception as err:
+                    print("WARNING: Could not refresh time offset: %s" % err)
+            self._publish()
+
+    def start(self, listener = None):
+        """ Keeps the offset up to date in a background thread, calling
+            listener with the new offset whenever it changes """
+        if listener:
+            self.listeners.append(listener)
+        self.running = True
+        self.thread = threading.Thread(target = self.loop, name = 'warble-ntp', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+def test():
+    """ Tests for combining NTP samples """
+    ntp = estimator('pool.ntp.org')
+    assert(ntp.combine([]) is None)
+    # The quickest answer per server wins, and the odd one out is thrown away
+    samples = [
+        sample('a', 0.010, 0.020),
+        sample('a', 0.300, 0.400),
+        sample('b', 0.012, 0.020),
+        sample('c', 0.011, 0.010),
+        sample('d', 5.000, 0.020),
+    ]
+    offset, error = ntp.combine(samples)
+    assert(0.010 <= offset <= 0.012)
+    assert(error < 0.01)
+    # A single server is taken at its word, give or take half the round trip
+    offset, error = ntp.combine([sample('a', -0.5, 0.1)])
+    assert(offset == -0.5 and abs(error - 0.05) < 1e-9)
+    print("NTP offset estimator works as intended!")
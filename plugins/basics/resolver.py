@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the caching DNS resolver for Apache Warble (incubating) nodes.
+    All probes share one cache of (host, address family) -> addresses,
+    which keeps answers for as long as their TTL says, and remembers
+    failed lookups for a little while too. When several probes ask for
+    the same uncached name at once, only one of them actually does the
+    lookup and the rest wait for its answer.
+
+    Names are looked up through dnspython, so we get to see the TTL. If
+    there is no usable DNS configuration, or the name servers time out,
+    we ask the system resolver instead. Failures we can't be sure of
+    (timeouts, temporary errors) are not cached, so the next check
+    tries again rather than failing for a while on a hiccup.
+"""
+
+import ipaddress
+import socket
+import threading
+import time
+
+import dns.exception
+import dns.rdatatype
+import dns.resolver
+
+class lookup():
+    """ A lookup in progress, shared by everyone waiting for the same name """
+    def __init__(self):
+        self.done = threading.Event()
+        self.addresses = None
+        self.error = None
+
+class transient(Exception):
+    """ A lookup that failed for reasons that may go away by themselves, not worth caching """
+    pass
+
+class resolver():
+    def __init__(self, negative = 30, fallback = 60, minimum = 1, maximum = 3600, maxentries = 100000, sweep = 1000):
+        self.negative = negative # Seconds to remember failed lookups for
+        self.fallback = fallback # TTL for answers from the system resolver, which doesn't tell us one
+        self.minimum = minimum # Clamp TTLs to this range
+        self.maximum = maximum
+        self.maxentries = maxentries # Most names to keep
+        self.sweep = sweep # Drop expired entries every this many new ones
+        self.inserts = 0
+        self.resolver = None # Set up on first use, so importing us doesn't need /etc/resolv.conf (False if there is none)
+        self.cache = {} # (host, family) -> (expires, addresses, error)
+        self.pending = {} # (host, family) -> lookup
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _system(self, host, family):
+        """ Looks up a host through the system resolver (/etc/hosts and friends),
+            returns a list of addresses or raises socket.gaierror """
+        addresses = []
+        for info in socket.getaddrinfo(host, None, family, socket.SOCK_STREAM):
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        return addresses
+
+    def _query(self, host, family):
+        """ Looks up a host, returns (addresses, ttl) or raises """
+        rdtype = dns.rdatatype.AAAA if family == socket.AF_INET6 else dns.rdatatype.A
+        if self.resolver is None:
+            try:
+                self.resolver = dns.resolver.Resolver()
+            except dns.resolver.NoResolverConfiguration as err:
+                print("WARNING: No usable DNS configuration (%s), falling back to the system resolver" % err)
+                self.resolver = False
+        error = None
+        temporary = False
+        if self.resolver:
+            try:
+                answer = self.resolver.resolve(host, rdtype, search = True)
+                return [x.address for x in answer], answer.rrset.ttl
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers) as err:
+                # Not in DNS, but it may still be in /etc/hosts and friends
+                error = str(err)
+            except dns.exception.Timeout as err:
+                # The system resolver may know better (or have it cached)
+                error = str(err)
+                temporary = True
+        try:
+            return self._system(host, family), self.fallback
+        except socket.gaierror as err:
+            if temporary or err.errno == socket.EAI_AGAIN:
+                raise transient(error or str(err))
+            raise Exception(error or str(err))
+
+    def resolve(self, host, family = socket.AF_INET, bypass = False):
+        """ Returns a list of addresses for host, from cache if we can.
+            With bypass set, always does a fresh lookup (and caches the result).
+            Returns (addresses, cached) or raises if the name doesn't resolve. """
+        # IP literals don't need looking up, but must be of the family asked for
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            address = None
+        if address:
+            if address.version != (6 if family == socket.AF_INET6 else 4):
+                raise Exception("%s is not an IPv%u address" % (host, 6 if family == socket.AF_INET6 else 4))
+            return [str(address)], False
+        key = (host.lower(), family)
+        now = time.monotonic()
+        with self.lock:
+            if not bypass:
+                entry = self.cache.get(key)
+                if entry and entry[0] > now:
+                    self.hits += 1
+                    if entry[2]:
+                        raise Exception(entry[2])
+                    return entry[1], True
+            self.misses += 1
+            # Someone else already looking this up? Wait for their answer.
+            pending = self.pending.get(key)
+            if pending and not bypass:
+                owner = False
+            else:
+                pending = lookup()
+                self.pending[key] = pending
+                owner = True
+        if not owner:
+            pending.done.wait()
+            if pending.error:
+                raise Exception(pending.error)
+            return pending.addresses, False
+        try:
+            addresses, ttl = self._query(host, family)
+            ttl = max(self.minimum, min(self.maximum, ttl))
+            entry = (time.monotonic() + ttl, addresses, None)
+            pending.addresses = addresses
+        except transient as err:
+            entry = None
+            pending.error = str(err)
+        except Exception as err:
+            entry = (time.monotonic() + self.negative, None, str(err))
+            pending.error = str(err)
+        with self.lock:
+            if entry:
+                self.cache[key] = entry
+                self.inserts += 1
+                if self.inserts % self.sweep == 0 or len(self.cache) > self.maxentries:
+                    self._expire()
+            if self.pending.get(key) is pending:
+                del self.pending[key]
+        pending.done.set()
+        if pending.error:
+            raise Exception(pending.error)
+        return pending.addresses, False
+
+    def _expire(self):
+        """ Drops expired entries, and the ones closest to expiring if we still
+            have too many. Must be called with the lock held. """
+        now = time.monotonic()
+        for key in [k for k, v in self.cache.items() if v[0] <= now]:
+            del self.cache[key]
+        if len(self.cache) > self.maxentries:
+            # Make some room, so we don't have to do this again on the next insert
+            for key in sorted(self.cache, key = lambda k: self.cache[k][0])[:len(self.cache) - self.maxentries * 9 // 10]:
+                del self.cache[key]
+
+    def expire(self):
+        """ Drops expired entries from the cache """
+        with self.lock:
+            self._expire()
+
+    def stats(self):
+        return {
+            'entries': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+# Shared cache for all probes on this node
+cache = resolver()
+
+def test():
+    """ Tests for the DNS cache, with a fake name server """
+    class answer(list):
+        def __init__(self, addresses, ttl):
+            super().__init__(type('rdata', (), {'address': a})() for a in addresses)
+            self.rrset = type('rrset', (), {'ttl': ttl})()
+    class nameserver():
+        def __init__(self, error = None):
+            self.error = error # Exception class to fail with, if any
+            self.queries = 0
+        def resolve(self, host, rdtype, search = True):
+            self.queries += 1
+            time.sleep(0.05)
+            if self.error:
+                raise self.error()
+            return answer(['192.0.2.%u' % (1 + i) for i in range(3)], 300)
+    r = resolver(maxentries = 10)
+    r.resolver = nameserver()
+    # IP literals aren't looked up, or cached
+    assert(r.resolve('192.0.2.7') == (['192.0.2.7'], False))
+    assert(r.resolve('2001:db8::1', socket.AF_INET6) == (['2001:db8::1'], False))
+    try:
+        r.resolve('192.0.2.7', socket.AF_INET6)
+        assert(False)
+    except Exception as err:
+        assert('not an IPv6' in str(err))
+    # Answers are cached, and simultaneous lookups of one name are done once
+    results = []
+    threads = [threading.Thread(target = lambda: results.append(r.resolve('www.example.org'))) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert(r.resolver.queries == 1 and len(results) == 10)
+    assert(all(x[0] == ['192.0.2.1', '192.0.2.2', '192.0.2.3'] for x in results))
+    assert(r.resolve('WWW.example.org') == (['192.0.2.1', '192.0.2.2', '192.0.2.3'], True))
+    assert(r.resolve('www.example.org', bypass = True)[1] == False and r.resolver.queries == 2)
+    # Names that don't exist anywhere are remembered for a while
+    r.resolver = nameserver(dns.resolver.NXDOMAIN)
+    for i in range(2):
+        try:
+            r.resolve('missing.invalid')
+            assert(False)
+        except Exception as err:
+            assert('does not exist' in str(err))
+    assert(r.resolver.queries == 1)
+    # Timeouts fall back to the system resolver, and aren't cached if that fails too
+    r.resolver = nameserver(dns.exception.Timeout)
+    assert(r.resolve('localhost') == (['127.0.0.1'], False))
+    for i in range(2):
+        try:
+            r.resolve('timeout.invalid')
+            assert(False)
+        except Exception as err:
+            assert('timed out' in str(err))
+    assert(r.resolver.queries == 3 and ('timeout.invalid', socket.AF_INET) not in r.cache)
+    # Without any DNS configuration, the system resolver does it all
+    r = resolver()
+    r.resolver = False
+    assert(r.resolve('localhost') == (['127.0.0.1'], False))
+    assert(r.resolve('localhost') == (['127.0.0.1'], True))
+    # The cache doesn't grow past its limit
+    r = resolver(maxentries = 10)
+    r.resolver = nameserver()
+    for i in range(25):
+        r.resolve('host%u.example.org' % i)
+    assert(len(r.cache) <= 10)
+    print("DNS cache works as intended!")
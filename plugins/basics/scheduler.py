@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the recurring task scheduler for Apache Warble (incubating)
+    nodes. It is a hashed timer wheel: every scheduled run lands in the
+    bucket for its tick, so adding or cancelling a task is O(1) no matter
+    how many tasks the node carries, and each tick only looks at the one
+    bucket that is due.
+
+    Run times are laid out on the NTP-corrected clock as fixed multiples
+    of each task's interval plus a deterministic per-task phase (jitter),
+    so checks do not all fire in the same second, nodes agree on when a
+    given task runs, and a late run never pushes the following ones back.
+"""
+
+import threading
+import time
+import zlib
+
+class entry():
+    """ A single scheduled task in the wheel """
+    __slots__ = ('id', 'task', 'interval', 'phase', 'deadline', 'tick', 'group')
+    def __init__(self, tid, task, interval, phase, group = None):
+        self.id = tid
+        self.task = task
+        self.interval = interval
+        self.phase = phase
+        self.group = group
+        self.deadline = 0
+        self.tick = 0
+
+class scheduler():
+    def __init__(self, globalConfig, callback, resolution = 0.1, slots = 4096, grouper = None, batch = None, backlog = None):
+        self.config = globalConfig
+        self.callback = callback # Called with the task dict whenever a task is due
+        self.grouper = grouper # Returns a group key for tasks that should run together, or None
+        self.batch = batch # Called with a list of tasks when several of a group are due at once
+        self.backlog = backlog # Returns how long dispatched tasks wait before they start (executor.lag)
+        self.resolution = resolution # Seconds per tick
+        self.slots = slots
+        self.buckets = [{} for i in range(slots)] # slot -> {task id: entry}
+        self.entries = {} # task id -> entry
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.tick = self._tick(self.now())
+        # Lag statistics
+        self.lastlag = 0.0
+        self.avglag = 0.0
+        self.maxlag = 0.0
+        self.fired = 0
+        self.skipped = 0
+
+    def now(self):
+        """ Returns the current NTP-adjusted time """
+        return time.time() - self.config['misc'].get('offset', 0)
+
+    def _tick(self, when):
+        return int(when / self.resolution)
+
+    def jitter(self, tid, interval):
+        """ Returns the deterministic start offset (0 <= x < interval) for a task id """
+        return (zlib.crc32(str(tid).encode('utf-8')) / 0x100000000) * interval
+
+    def _place(self, e, now):
+        """ Puts an entry into the bucket for its next deadline after now """
+        runs = int((now - e.phase) // e.interval) + 1
+        e.deadline = runs * e.interval + e.phase
+        self._file(e)
+
+    def _file(self, e):
+        """ Puts an entry into the bucket for its deadline """
+        e.tick = max(self._tick(e.deadline), self.tick)
+        self.buckets[e.tick % self.slots][e.id] = e
+
+    def add(self, task, interval = None):
+        """ Schedules a task to run every interval seconds, replacing any existing schedule for it """
+        tid = task.get('id')
+        interval = float(interval or task.get('interval', 60))
+        if interval <= 0:
+            raise ValueError("Task %s has a non-positive interval" % tid)
+        # Tasks in the same group share their phase, so they come due together
+        group = self.grouper(task) if self.grouper else None
+        e = entry(tid, task, interval, self.jitter(tid if group is None else group, interval), group)
+        with self.lock:
+            self._cancel(tid)
+            self.entries[tid] = e
+            self._place(e, self.now())
+        return e.deadline
+
+    def cancel(self, tid):
+        """ Removes a task from the schedule, returns True if it was scheduled """
+        with self.lock:
+            return self._cancel(tid)
+
+    def _cancel(self, tid):
+        e = self.entries.pop(tid, None)
+        if e:
+            del self.buckets[e.tick % self.slots][tid]
+            return True
+        return False
+
+    def update(self, tasks):
+        """ Syncs the schedule with a fresh task list from the master.
+            Tasks no longer in the list are cancelled, new or changed ones
+            are (re)scheduled, and untouched ones keep their place. """
+        seen = set()
+        for task in tasks:
+            tid = task.get('id')
+            seen.add(tid)
+            e = self.entries.get(tid)
+            if e and e.task == task:
+                continue
+            self.add(task)
+        with self.lock:
+            for tid in [x for x in self.entries if x not in seen]:
+                self._cancel(tid)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def advance(self, now = None):
+        """ Processes every tick up to now, firing due tasks. Returns the number of tasks fired """
+        now = self.now() if now is None else now
+        target = self._tick(now)
+        due = []
+        with self.lock:
+            # If we fell more than a full turn of the wheel behind, there is no
+            # point in walking the same buckets over and over again.
+            if target - self.tick >= self.slots:
+                self.tick = target - self.slots + 1
+            while self.tick <= target:
+                bucket = self.buckets[self.tick % self.slots]
+                for e in [x for x in bucket.values() if x.tick <= self.tick]:
+                    del bucket[e.id]
+                    due.append(e)
+                self.tick += 1
+            self.tick = target
+            for e in due:
+                lag = max(0, now - e.deadline) # Tasks may fire up to one tick early
+                # Missed whole intervals are skipped, not run back to back
+                if lag >= e.interval:
+                    self.skipped += int(lag // e.interval)
+                self.lastlag = lag
+                self.avglag = 0.9 * self.avglag + 0.1 * lag
+                self.maxlag = max(self.maxlag, lag)
+                self.fired += 1
+                if e.deadline + e.interval > now:
+                    # Go from the deadline, not from now, as we may have fired a little early
+                    e.deadline += e.interval
+                    self._file(e)
+                else:
+                    self._place(e, now)
+        groups = {}
+        for e in due:
+            if e.group is not None and self.batch:
+                groups.setdefault((e.group, e.interval), []).append(e.task)
+                continue
+            try:
+                self.callback(e.task)
+            except Exception as err:
+                print("ALERT: Could not dispatch task %s: %s" % (e.id, err))
+        for tasks in groups.values():
+            try:
+                if len(tasks) > 1:
+                    self.batch(tasks)
+                else:
+                    self.callback(tasks[0])
+            except Exception as err:
+                print("ALERT: Could not dispatch task group %s: %s" % ([t.get('id') for t in tasks], err))
+        return len(due)
+
+    def lag(self):
+        """ Returns lag statistics, in seconds. Lag is how late tasks start:
+            how late we dispatch them, plus how long they then wait for a
+            free slot if we know that. Runs dropped because the previous
+            one hadn't started yet count as skipped. """
+        stats = {
+            'last': self.lastlag,
+            'average': self.avglag,
+            'max': self.maxlag,
+            'fired': self.fired,
+            'skipped': self.skipped,
+            'scheduled': len(self.entries),
+        }
+        if self.backlog:
+            waits = self.backlog()
+            stats['last'] += waits['last']
+            stats['average'] += waits['average']
+            stats['max'] = max(stats['max'], waits['max'])
+            stats['skipped'] += waits.get('skipped', 0)
+        return stats
+
+    def loop(self):
+        """ Main scheduler loop, ticks until stopped """
+        while self.running:
+            self.advance()
+            # Sleep until the start of the next tick
+            time.sleep(max(0, (self.tick + 1) * self.resolution - self.now()))
+
+    def start(self):
+        """ Starts the scheduler in a background thread """
+        self.running = True
+        self.thread = threading.Thread(target = self.loop, name = 'warble-scheduler', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+def test():
+    """ Tests for the scheduler: every task fires once per interval """
+    fires = {}
+    s = scheduler({'misc': {}}, lambda task: fires.setdefault(task['id'], []).append(now))
+    for i in range(100):
+        s.add({'id': i, 'interval': 1})
+    start = s.now()
+    now = start
+    while now < start + 5:
+        s.advance(now)
+        now += s.resolution / 3 # Several loops per tick, like a real loop waking up early
+    for tid, times in fires.items():
+        assert(4 <= len(times) <= 6)
+        assert(all(b - a > 1 - 2 * s.resolution for a, b in zip(times, times[1:])))
+    assert(len(fires) == 100)
+    assert(s.lag()['skipped'] == 0)
+    print("Scheduler works as intended!")
@@ -20,13 +20,18 @@ This is the TCP/UDP Socket Library for Apache Warble (incubating)
 """
 
 # Socket imports
-import select
+import errno
+import os
 import socket
 import ssl
 import struct
 from socket import AF_INET, SOCK_DGRAM
 import time
 
+import plugins.basics.ioloop
+import plugins.basics.resolver
+import plugins.basics.tls
+
 
 class tcp():
     def __init__(self, testParameters, report):
@@ -45,11 +50,39 @@ class tcp():
         self.server = None
         self.realip = None
         self.cert = None
+        self.tlskey = None # (host, port, SNI, verify) once we're using TLS, for session caching
+        self.bufsize = int(testParameters.get('buffer', 16384)) # Read buffer size
+        self._reader = None
+    
+        # Dual-stack mode races connections over IPv6 and IPv4 (RFC 8305, Happy Eyeballs)
+        self.dualstack = testParameters.get('dualstack', False) == True
+        self.candidates = [] # (address family, socket address) pairs to try, in order
     
         try:
-            self.report.debug("Looking up hostname %s..." % self.host)
-            af, socktype, proto, canonname, sa = socket.getaddrinfo(self.host, self.port, self.iptype, socket.SOCK_STREAM)[0]
+            self.report.debug("Looking up hostname %s...", self.host)
+            # Use the shared DNS cache, unless the task wants to measure resolution
+            bypass = testParameters.get('dnscache', True) == False
+            families = [socket.AF_INET6, socket.AF_INET] if self.dualstack else [self.iptype]
+            resolved = []
+            errors = []
+            for family in families:
+                try:
+                    addresses, cached = plugins.basics.resolver.cache.resolve(self.host, family, bypass = bypass)
+                    if cached:
+                        self.report.debug("Found %s in DNS cache", self.host)
+                    resolved.append([(family, (a, self.port) if family == socket.AF_INET else (a, self.port, 0, 0)) for a in addresses])
+                except Exception as err:
+                    errors.append(str(err))
             self.report.timer('dns')
+            if not resolved:
+                raise Exception("; ".join(errors))
+            # Interleave the address families, preferred (IPv6) family first
+            while any(resolved):
+                for family in resolved:
+                    if family:
+                        self.candidates.append(family.pop(0))
+            af, sa = self.candidates[0]
+            socktype, proto = socket.SOCK_STREAM, 0
             self.sa = sa
         except Exception as err:
             raise Exception("Could not resolve hostname: %s" % err)
@@ -62,87 +95,321 @@ class tcp():
         if self.realip and self.realip == '127.0.0.1' or self.realip == '::1':
             self.report.error('dns', "Hostname %s points to localhost!" % self.host)
             return None
-        self.report.debug("Connecting to %s:%u" % (self.realip, self.port))
+        self.report.debug("Connecting to %s:%u", self.realip, self.port)
         self.socket = socket.socket(af, socktype, proto)
     
     def __del__(self):
         # Close socket if not already closed
         try:
-            self.socket.close()
+            self.close()
         except:
             pass
     
-    def secure(self, SNI = None, verify = False):
-        """ Wrap socket in OpenSSL """
+    def close(self):
+        """ Closes the socket, keeping the TLS session around for the next probe """
+        if self.tlskey and isinstance(self.socket, ssl.SSLSocket):
+            try:
+                plugins.basics.tls.shared.save(self.tlskey, self.socket.session)
+            except Exception:
+                pass
+            self.tlskey = None
+        self.socket.close()
+    
+    def secure(self, SNI = None, verify = False, resume = True):
+        """ Wrap socket in OpenSSL. Contexts are shared between checks, and
+            with resume set, so are TLS sessions for the same host, port and SNI.
+            Set resume to False to measure a full handshake. """
         self.report.debug("Wrapping socket for TLS")
+        context = plugins.basics.tls.shared.context(verify = verify == True, sni = bool(SNI))
         if SNI:
-            self.report.debug("Using SNI extension for %s" % SNI)
-            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2) # SSL, TLS1, TLS1.1 is largely deprecated now.
-            context.verify_mode = ssl.CERT_OPTIONAL
-            # Are we going to test the certificate for validity?
-            if verify == True:
-                context.verify_mode = ssl.CERT_REQUIRED
-            context.check_hostname = True
-            context.load_default_certs()
-            
-            self.socket = context.wrap_socket(self.socket, server_hostname = SNI)
-            
-            while True:
-                try:
-                    self.socket.do_handshake()
-                    break
-                except ssl.SSLWantReadError:
-                    select.select([self.socket], [], [])
-                except ssl.SSLWantWriteError:
-                    select.select([], [self.socket], [])
-            self.report.debug("Shook hands, TLS ready")
-            
-            return context
-        else:
-            self.socket = ssl.wrap_socket(self.socket)
+            self.report.debug("Using SNI extension for %s", SNI)
+        # Sessions belong to the context they were made with, so verified and unverified checks keep their own
+        self.tlskey = (self.host, self.port, SNI, verify == True)
+        session = plugins.basics.tls.shared.session(self.tlskey) if resume else None
+        self.socket.setblocking(False)
+        self.socket = context.wrap_socket(self.socket, server_hostname = SNI, session = session, do_handshake_on_connect = False)
         
+        while True:
+            try:
+                self.socket.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                self.wait(plugins.basics.ioloop.EVENT_READ, "TLS handshake")
+            except ssl.SSLWantWriteError:
+                self.wait(plugins.basics.ioloop.EVENT_WRITE, "TLS handshake")
+        self.report.debug("Shook hands, TLS ready")
+        resumed = self.socket.session_reused
+        if session and not resumed:
+            # Server wouldn't take it, no point in offering it again
+            plugins.basics.tls.shared.forget(self.tlskey)
+        self.report.note('resumed', bool(resumed))
+        if resumed:
+            self.report.debug("Resumed TLS session")
+        # TLS 1.2 sessions are ready now, TLS 1.3 tickets come in later and are saved on close()
+        plugins.basics.tls.shared.save(self.tlskey, self.socket.session)
+        
+        return context
         
     def connect(self):
         try:
-            self.socket.connect(self.sa)
+            if self.dualstack and len(self.candidates) > 1:
+                self.race()
+            else:
+                plugins.basics.ioloop.shared.connect(self.socket, self.sa, timeout = 3)
             self.report.timer('connect')
+            self.report.note('family', 'ipv6' if self.socket.family == socket.AF_INET6 else 'ipv4')
+            self.report.note('address', self.realip)
         except Exception as err:
             print("Connection to %s failed" % self.realip)
             raise Exception("Could not connect to host: %s" % str(err))
     
+    def race(self, delay = 0.25, timeout = 3):
+        """ Connects to all candidate addresses with staggered starts, keeping
+            whichever connection is established first (RFC 8305). A failed
+            attempt starts the next one right away instead of waiting. """
+        pending = list(self.candidates)
+        attempts = {} # socket -> (family, address)
+        errors = []
+        winner = None
+        deadline = time.monotonic() + timeout
+        nextstart = time.monotonic()
+        try:
+            while winner is None:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise Exception("Connection timed out after %u seconds (%s)" % (timeout, "; ".join(errors) or "no response"))
+                # Start the next attempt if it's time, or if nothing is in flight
+                if pending and (now >= nextstart or not attempts):
+                    af, sa = pending.pop(0)
+                    self.report.debug("Trying %s:%u", sa[0], self.port)
+                    sock = socket.socket(af, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(sa)
+                    if err == 0:
+                        winner = (sock, af, sa)
+                        break
+                    elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                        attempts[sock] = (af, sa)
+                        nextstart = now + delay
+                    else:
+                        sock.close()
+                        errors.append("%s: %s" % (sa[0], os.strerror(err)))
+                        nextstart = now
+                    continue
+                if not attempts:
+                    raise Exception("; ".join(errors))
+                wait = deadline - now
+                if pending:
+                    wait = min(wait, max(0, nextstart - now))
+                writable = plugins.basics.ioloop.shared.wait(list(attempts), plugins.basics.ioloop.EVENT_WRITE, wait)
+                for sock in writable:
+                    af, sa = attempts.pop(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        winner = (sock, af, sa)
+                        break
+                    sock.close()
+                    errors.append("%s: %s" % (sa[0], os.strerror(err)))
+                    nextstart = time.monotonic()
+        finally:
+            for sock in attempts:
+                sock.close()
+        sock, af, sa = winner
+        self.socket.close()
+        self.socket = sock
+        self.sa = sa
+        self.realip = sa[0]
+        self.report.debug("Connected to %s:%u first", self.realip, self.port)
+    
+    def wait(self, events, what = "Socket", timeout = 60):
+        """ Waits for the socket to become readable/writable, raises after timeout seconds """
+        if not plugins.basics.ioloop.shared.wait(self.socket, events, timeout):
+            raise Exception("%s timeout after %u seconds" % (what, timeout))
+    
     def send(self, b):
         """ Send bytes (or convert string to bytes) to socket """
         if type(b) is str:
-            self.socket.send(b.encode('ascii', errors = 'replace'))
-        else:
-            self.socket.send(b)
-        
-    def readline(self, recv_buffer=256, delim=b'\n'):
-        """ Reads a line from a TCP (SSL?) socket, if presented within 60 seconds """
-        buffer = b''
-        data = True
-        self.socket.setblocking(0)
-        while data:
+            b = b.encode('ascii', errors = 'replace')
+        view = memoryview(b)
+        while len(view):
             try:
-                data = self.socket.recv(recv_buffer)
-                buffer += data
-                self.bytes += len(data)
-                while delim in buffer:
-                    line, buffer = buffer.split(delim, 1)
-                    yield line
-            except BlockingIOError as err:
-                ready = select.select([self.socket], [], [], 60)
-                if ready[0]:
-                    continue
-                else:
-                    raise Exception("Socket timeout after 60 seconds")
-            except ssl.SSLWantReadError as err:
-                ready = select.select([self.socket], [], [], 60)
-                if ready[0]:
-                    continue
-                else:
-                    raise Exception("Socket timeout after 60 seconds")
-            except Exception as err:
-                print(type(err))
-                raise err
+                view = view[self.socket.send(view):]
+            except (BlockingIOError, ssl.SSLWantWriteError):
+                self.wait(plugins.basics.ioloop.EVENT_WRITE)
+            except ssl.SSLWantReadError:
+                self.wait(plugins.basics.ioloop.EVENT_READ)
         
+    def reader(self):
+        """ Returns the buffered reader for this connection """
+        if not self._reader:
+            self._reader = reader(self, size = self.bufsize)
+        return self._reader
+    
+    def readline(self, recv_buffer=None, delim=b'\n'):
+        """ Reads lines from a TCP (SSL?) socket, if presented within 60 seconds each """
+        r = self.reader()
+        while True:
+            try:
+                yield r.readline(delim)
+            except EOFError:
+                return
+
+
+class reader():
+    """ Buffered reader for a tcp connection. Data is received straight into
+        one reusable bytearray with recv_into, and delimiter searches pick up
+        where the previous search left off, so long lines don't get copied or
+        rescanned over and over. """
+    def __init__(self, conn, size = 16384, timeout = 60):
+        self.conn = conn # tcp object, so we follow it if the socket gets wrapped for TLS
+        self.buffer = bytearray(size)
+        self.start = 0 # First unread byte in the buffer
+        self.end = 0 # End of valid data in the buffer
+        self.scanned = 0 # Delimiter search resumes from here
+        self.timeout = timeout
+        self.eof = False
+    
+    def available(self):
+        return self.end - self.start
+    
+    def fill(self):
+        """ Receives more data into the buffer, returns the number of bytes received (0 at EOF) """
+        if self.eof:
+            return 0
+        if self.end == len(self.buffer):
+            if self.start > 0:
+                # Move unread data to the front to make room
+                n = self.end - self.start
+                self.buffer[:n] = self.buffer[self.start:self.end]
+                self.scanned -= self.start
+                self.start = 0
+                self.end = n
+            else:
+                # Buffer is full of unread data, grow it
+                self.buffer.extend(bytes(len(self.buffer)))
+        sock = self.conn.socket
+        sock.setblocking(False)
+        while True:
+            try:
+                with memoryview(self.buffer) as view:
+                    n = sock.recv_into(view[self.end:])
+                break
+            except (BlockingIOError, ssl.SSLWantReadError):
+                self.conn.wait(plugins.basics.ioloop.EVENT_READ, timeout = self.timeout)
+            except ssl.SSLWantWriteError:
+                self.conn.wait(plugins.basics.ioloop.EVENT_WRITE, timeout = self.timeout)
+        if n == 0:
+            self.eof = True
+        self.end += n
+        self.conn.bytes += n
+        return n
+    
+    def _take(self, n):
+        """ Consumes n bytes from the buffer and returns them """
+        data = bytes(self.buffer[self.start:self.start+n])
+        self.start += n
+        self.scanned = self.start
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+        return data
+    
+    def readuntil(self, delim = b'\n', limit = None):
+        """ Reads up to and including delim. Raises EOFError if the connection
+            closes first, or ValueError if no delim is found within limit bytes """
+        while True:
+            i = self.buffer.find(delim, max(self.start, self.scanned), self.end)
+            if i >= 0:
+                return self._take(i + len(delim) - self.start)
+            # Next search only needs to look at new data, plus a partial delimiter
+            self.scanned = max(self.start, self.end - len(delim) + 1)
+            if limit and self.available() > limit:
+                raise ValueError("No delimiter found within %u bytes" % limit)
+            if not self.fill():
+                raise EOFError("Connection closed before delimiter was found")
+    
+    def readline(self, delim = b'\n', limit = None):
+        """ Reads a line, without the delimiter """
+        return self.readuntil(delim, limit)[:-len(delim)]
+    
+    def readexactly(self, n):
+        """ Reads exactly n bytes, raises EOFError if the connection closes first """
+        while self.available() < n:
+            if not self.fill():
+                raise EOFError("Connection closed after %u of %u bytes" % (self.available(), n))
+        return self._take(n)
+    
+    def peek(self):
+        """ Returns a view of the buffered data, receiving more if the buffer is
+            empty. Empty at EOF. The view must be released before reading on. """
+        if not self.available():
+            self.fill()
+        return memoryview(self.buffer)[self.start:self.end]
+    
+    def skip(self, n):
+        """ Consumes n bytes of buffered data without copying them """
+        self.start += n
+        self.scanned = max(self.scanned, self.start)
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+    
+    def read(self, n = -1):
+        """ Reads up to n bytes (or whatever is buffered, if n is -1), receiving
+            more only if the buffer is empty. Returns b'' at EOF. """
+        if not self.available():
+            self.fill()
+        return self._take(self.available() if n < 0 else min(n, self.available()))
+
+def test():
+    """ Tests for the buffered reader, over a local socket pair """
+    import threading
+    ours, theirs = socket.socketpair()
+    conn = tcp.__new__(tcp) # Just the parts the reader needs, no lookups or connecting
+    conn.socket = ours
+    conn.bytes = 0
+    conn.tlskey = None
+    r = reader(conn, size = 8, timeout = 5)
+    # Lines longer than the buffer, delimiters split across receives
+    pieces = (b"short\r", b"\na much longer line than the buffer\r\n", b"tail", b"less\r\n", b"0123456789" * 10)
+    def talk():
+        for piece in pieces:
+            theirs.sendall(piece)
+            time.sleep(0.01)
+        theirs.shutdown(socket.SHUT_WR)
+    t = threading.Thread(target = talk)
+    t.start()
+    assert(r.readline(b"\r\n") == b"short")
+    assert(r.readuntil(b"\r\n") == b"a much longer line than the buffer\r\n")
+    assert(r.readline(b"\r\n") == b"tailless")
+    assert(r.readexactly(15) == b"012345678901234")
+    # The rest, without and with copying
+    with r.peek() as view:
+        rest = bytes(view)
+    r.skip(len(rest))
+    while True:
+        data = r.read(7)
+        if not data:
+            break
+        rest += data
+    t.join()
+    assert(rest == (b"0123456789" * 10)[15:])
+    assert(r.eof and conn.bytes == len(b"".join(pieces)))
+    try:
+        r.readexactly(1)
+        assert(False)
+    except EOFError:
+        pass
+    # No runaway lines
+    ours.close()
+    theirs.close()
+    ours, theirs = socket.socketpair()
+    conn.socket = ours
+    r = reader(conn, size = 8, timeout = 5)
+    theirs.sendall(b"x" * 100)
+    try:
+        r.readline(limit = 50)
+        assert(False)
+    except ValueError:
+        pass
+    ours.close()
+    theirs.close()
+    print("Socket reader works as intended!")
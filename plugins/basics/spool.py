@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the on-disk result spool for Apache Warble (incubating) nodes.
+    When the master can't be reached, result batches are appended to a
+    series of segment files instead of being dropped, and replayed oldest
+    first once the master is back. Each record is framed as
+
+        length (4) | crc32 (4) | data
+
+    Writes are only fsync'ed every so often rather than per record, and
+    when the spool grows past its size limit, whole segments are evicted
+    from the oldest end. A record cut short by a crash is ignored on read.
+    How far replay has got is kept in a small cursor file, so records
+    that were already delivered aren't sent again after a restart.
+"""
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+RECORD_HEADER = struct.Struct('!II')
+
+class spool():
+    def __init__(self, path, segment = 4 * 1024 * 1024, maxsize = 256 * 1024 * 1024, syncbytes = 1024 * 1024, syncinterval = 1.0):
+        self.path = path
+        self.segment = segment # Max bytes per segment file before we roll over
+        self.maxsize = maxsize # Max bytes for the whole spool
+        self.syncbytes = syncbytes # fsync once this many bytes are unsynced...
+        self.syncinterval = syncinterval # ...or this many seconds have passed since the last fsync
+        self.lock = threading.Lock()
+        self.evicted = 0
+        os.makedirs(path, mode = 0o700, exist_ok = True)
+        self.segments = sorted(int(x[:-4]) for x in os.listdir(path) if x.endswith('.seg') and x[:-4].isdigit())
+        self.sizes = {n: os.path.getsize(self.filename(n)) for n in self.segments}
+        self.current = None # File object of the segment we are appending to
+        self.unsynced = 0
+        self.lastsync = time.monotonic()
+        self.cursor = self._loadcursor() # (segment, records already replayed from it)
+
+    def filename(self, n):
+        return os.path.join(self.path, "%016u.seg" % n)
+
+    def _loadcursor(self):
+        try:
+            with open(os.path.join(self.path, 'cursor')) as f:
+                n, skip = (int(x) for x in f.read().split())
+            if n in self.sizes:
+                return (n, skip)
+        except (OSError, ValueError):
+            pass
+        return (None, 0)
+
+    def _savecursor(self, cursor):
+        """ Remembers how far replay has got, atomically """
+        self.cursor = cursor
+        filename = os.path.join(self.path, 'cursor')
+        try:
+            with open(filename + '.tmp', 'w') as f:
+                f.write("%u %u\n" % (cursor[0] or 0, cursor[1]))
+            os.replace(filename + '.tmp', filename)
+        except OSError as err:
+            print("WARNING: Could not save spool replay position: %s" % err)
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def __len__(self):
+        """ Returns the number of segments in the spool """
+        return len(self.segments)
+
+    def _roll(self):
+        """ Closes the current segment and starts a new one """
+        if self.current:
+            self._sync()
+            self.current.close()
+        n = (self.segments[-1] + 1) if self.segments else 1
+        self.segments.append(n)
+        self.sizes[n] = 0
+        self.current = open(self.filename(n), 'ab')
+
+    def _sync(self):
+        if self.current and self.unsynced:
+            self.current.flush()
+            os.fsync(self.current.fileno())
+        self.unsynced = 0
+        self.lastsync = time.monotonic()
+
+    def _evict(self):
+        """ Drops the oldest segments until we're within our size limit """
+        while self.size() > self.maxsize and len(self.segments) > 1:
+            n = self.segments.pop(0)
+            del self.sizes[n]
+            try:
+                os.unlink(self.filename(n))
+            except FileNotFoundError:
+                pass
+            if self.cursor[0] == n:
+                self._savecursor( (None, 0) )
+            self.evicted += 1
+
+    def append(self, data):
+        """ Appends a record to the spool """
+        record = RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self.lock:
+            if not self.current or self.sizes[self.segments[-1]] + len(record) > self.segment:
+                self._roll()
+            self.current.write(record)
+            self.sizes[self.segments[-1]] += len(record)
+            self.unsynced += len(record)
+            if self.unsynced >= self.syncbytes or time.monotonic() - self.lastsync >= self.syncinterval:
+                self._sync()
+            self._evict()
+
+    def sync(self):
+        """ Forces unsynced records to disk """
+        with self.lock:
+            self._sync()
+
+    def read(self, n):
+        """ Reads all intact records from a segment, in one sequential read """
+        with open(self.filename(n), 'rb') as f:
+            data = f.read()
+        view = memoryview(data)
+        records = []
+        i = 0
+        while i + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, i)
+            i += RECORD_HEADER.size
+            if i + length > len(data):
+                break # Cut short by a crash, nothing more to read
+            record = bytes(view[i:i+length])
+            if zlib.crc32(record) != crc:
+                break
+            records.append(record)
+            i += length
+        return records
+
+    def replay(self, send):
+        """ Sends spooled records, oldest first, through send(record), which
+            should return True on success. Fully delivered segments are
+            deleted. Stops at the first failure, and picks up after the last
+            delivered record on the next call. Returns the number of records sent. """
+        sent = 0
+        while True:
+            with self.lock:
+                if not self.segments:
+                    return sent
+                n = self.segments[0]
+                # Don't read the segment we're appending to while it's open, roll over first
+                if self.current and n == self.segments[-1]:
+                    if not self.sizes[n]:
+                        return sent
+                    self._sync()
+                    self.current.close()
+                    self.current = None
+            records = self.read(n)
+            skip = self.cursor[1] if self.cursor[0] == n else 0
+            for record in records[skip:]:
+                if not send(record):
+                    return sent
+                sent += 1
+                skip += 1
+                self._savecursor( (n, skip) )
+            with self.lock:
+                if n in self.sizes:
+                    self.segments.remove(n)
+                    del self.sizes[n]
+                    os.unlink(self.filename(n))
+                self._savecursor( (None, 0) )
+
+    def close(self):
+        with self.lock:
+            if self.current:
+                self._sync()
+                self.current.close()
+                self.current = None
+
+def test():
+    """ Tests for the result spool """
+    import tempfile
+    with tempfile.TemporaryDirectory() as path:
+        s = spool(path, segment = 100)
+        for i in range(10):
+            s.append(b"batch %02u " % i + b"x" * 30)
+        assert(len(s) > 1) # Rolled over into several segments
+        # Replay stops at the first failure, and picks up from there
+        sent = []
+        def flaky(record):
+            if len(sent) == 4:
+                return False
+            sent.append(record)
+            return True
+        assert(s.replay(flaky) == 4)
+        s.close()
+        # A restart resumes after the last delivered record
+        s = spool(path, segment = 100)
+        assert(s.replay(lambda record: sent.append(record) or True) == 6)
+        assert(sent == [b"batch %02u " % i + b"x" * 30 for i in range(10)])
+        assert(len(s) == 0)
+        # A record cut short by a crash is ignored
+        s.append(b"whole")
+        s.append(b"torn record")
+        s.close()
+        with open(s.filename(s.segments[-1]), 'r+b') as f:
+            f.truncate(os.path.getsize(s.filename(s.segments[-1])) - 3)
+        assert(spool(path).read(s.segments[-1]) == [b"whole"])
+    print("Result spool works as intended!")
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the shared TLS state for Apache Warble (incubating) nodes.
+    Setting up an SSL context and loading the CA store is expensive, so
+    there is one context per (verify mode, SNI policy), shared by all
+    checks. TLS sessions are kept per (host, port, SNI, verify mode) so
+    repeat probes of the same service can resume them instead of doing a
+    full handshake.
+"""
+
+import collections
+import ssl
+import threading
+
+class cache():
+    def __init__(self, maxsessions = 10000):
+        self.lock = threading.Lock()
+        self.contexts = {} # (verify, sni) -> SSLContext
+        self.sessions = collections.OrderedDict() # (host, port, SNI, verify) -> SSLSession, in LRU order
+        self.maxsessions = maxsessions
+
+    def context(self, verify = False, sni = True):
+        """ Returns the shared context for a verify mode and SNI policy """
+        key = (verify, sni)
+        with self.lock:
+            context = self.contexts.get(key)
+            if not context:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.minimum_version = ssl.TLSVersion.TLSv1_2 # SSL, TLS1, TLS1.1 is largely deprecated now.
+                if sni:
+                    context.check_hostname = True
+                    context.verify_mode = ssl.CERT_REQUIRED if verify else ssl.CERT_OPTIONAL
+                else:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                context.load_default_certs()
+                self.contexts[key] = context
+            return context
+
+    def session(self, key):
+        """ Returns the cached session for (host, port, SNI, verify), if any """
+        with self.lock:
+            session = self.sessions.get(key)
+            if session:
+                self.sessions.move_to_end(key)
+            return session
+
+    def save(self, key, session):
+        """ Stores a session for later resumption """
+        if not session:
+            return
+        with self.lock:
+            self.sessions[key] = session
+            self.sessions.move_to_end(key)
+            while len(self.sessions) > self.maxsessions:
+                self.sessions.popitem(last = False)
+
+    def forget(self, key):
+        with self.lock:
+            self.sessions.pop(key, None)
+
+# Shared TLS state for all probes on this node
+shared = cache()
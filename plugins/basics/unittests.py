@@ -22,6 +22,27 @@
 import plugins.basics
 import plugins.tests
 import datetime
+import importlib
+
+# Modules with a test() of their own, run before the network tests
+SELFTESTS = [
+    'plugins.basics.certs',
+    'plugins.basics.executor',
+    'plugins.basics.httpparser',
+    'plugins.basics.ingest',
+    'plugins.basics.ntp',
+    'plugins.basics.resolver',
+    'plugins.basics.scheduler',
+    'plugins.basics.socket',
+    'plugins.basics.spool',
+    'plugins.basics.uploader',
+    'plugins.basics.workers',
+]
+
+def selftest():
+    for name in SELFTESTS:
+        print("Testing %s" % name)
+        importlib.import_module(name).test()
 
 def spit(t):
     # All done, spit out report
@@ -30,19 +51,14 @@ def spit(t):
     
     print("DEBUG:")
     print('-' * 80)
-    for k, v in t.report._debug:
+    for k, v in t.report.log():
         print(datetime.datetime.fromtimestamp(k).strftime("%Y-%m-%d %H:%M:%S.%f"), v)
     print('-' * 80)
     print("TIMESTAMPS:")
     print('-' * 80)
-    previous = None
-    first = None
-    for k, v in sorted(t.report.timeseries.items(), key = lambda x: x[1]):
-        if not previous:
-            previous = v
-            first = v
-        print("%-10s: +%3dms (%3dms)" % (k, ((v - previous) * 1000), (v - first) * 1000))
-        previous = v
+    durations = t.report.durations
+    for k, v in t.report.phases():
+        print("%-10s: +%10.3fms (%10.3fms)" % (k, durations[k] / 1000, v / 1e6))
     print('-' * 80)
 
 def uprint(t, params):
@@ -53,6 +69,7 @@ def uprint(t, params):
     print('-' * 80)
     
 def run(gc):
+    selftest()
     gc['debug'] = True
     
     # TCP test
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the result uploader for Apache Warble (incubating) nodes.
+    Finished reports are queued up and sent to the master in batches,
+    whenever a batch is full or the oldest queued report has waited long
+    enough. Each batch is compressed, signed with the node key and, if we
+    know the master's public key, encrypted. Batches that can't be
+    delivered are written to the on-disk spool and replayed later.
+    
+    With merkle signing, the batch is signed through a Merkle tree over
+    its reports instead, and every report carries an inclusion proof, so
+    the master can verify results one by one at the cost of a single RSA
+    signature per batch.
+"""
+
+import base64
+import collections
+import json
+import threading
+import time
+import zlib
+
+import plugins.basics.crypto
+import plugins.reports.generic
+
+class uploader():
+    def __init__(self, globalConfig, master, privkey, batch = 500, interval = 5000, maxqueue = 100000, spool = None, signing = 'payload'):
+        self.config = globalConfig
+        self.master = master # plugins.basics.master.client
+        self.privkey = privkey
+        self.masterkey = None
+        if globalConfig['client'].get('masterkey'):
+            self.masterkey = plugins.basics.crypto.loads(globalConfig['client']['masterkey'])
+        self.batch = batch # Flush once this many reports are queued...
+        self.interval = interval / 1000.0 # ...or once the oldest one has waited this long (ms)
+        self.maxqueue = maxqueue
+        self.spool = spool # plugins.basics.spool.spool for batches we couldn't deliver, if any
+        self.signing = signing # 'payload' signs the upload body, 'merkle' each report through a Merkle tree
+        self.queue = collections.deque() # (time queued, serialized report)
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        # Statistics
+        self.sent = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.lastlatency = 0.0
+        self.avglatency = 0.0
+
+    def add(self, task, t):
+        """ Queues the report of a finished test. Matches the executor callback signature """
+        self.put(t.report.dumps(task = task.get('id')))
+
+    def put(self, report):
+        """ Queues a report for upload, either as a dict or as JSON already serialized by the report """
+        if not isinstance(report, bytes):
+            report = plugins.reports.generic.encoder.encode(report).encode('utf-8')
+        with self.cond:
+            self.queue.append( (time.monotonic(), report) )
+            if len(self.queue) > self.maxqueue:
+                self.queue.popleft()
+                self.dropped += 1
+            if len(self.queue) >= self.batch:
+                self.cond.notify()
+
+    def compress(self, reports):
+        """ Compresses a list of serialized reports into one JSON array. With
+            merkle signing, it's an object with the signed root and the
+            reports (as the exact strings that were hashed) with their proofs """
+        if self.signing == 'merkle':
+            root, sig, proofs = plugins.basics.crypto.signbatch(self.privkey, reports)
+            results = [b'{"report":%s,"proof":%s}' % (json.dumps(str(report, 'utf-8')).encode('utf-8'), json.dumps(proof, separators = (',', ':')).encode('ascii'))
+                       for report, proof in zip(reports, proofs)]
+            return zlib.compress(b'{"root":"%s","signature":"%s","results":[' % (base64.b64encode(root), base64.b64encode(sig)) + b','.join(results) + b']}', 6)
+        return zlib.compress(b'[' + b','.join(reports) + b']', 6)
+
+    def pack(self, data):
+        """ Turns compressed reports into a signed (and optionally encrypted) upload body """
+        # Spooled batches keep whatever signing they were made with
+        merkle = zlib.decompressobj().decompress(data, 8) == b'{"root":'
+        encrypted = False
+        if self.masterkey:
+            data = plugins.basics.crypto.encrypt(self.masterkey, data)
+            encrypted = True
+        payload = str(base64.b64encode(data), 'ascii')
+        if merkle:
+            return {
+                'compression': 'zlib',
+                'encrypted': encrypted,
+                'signing': 'merkle',
+                'payload': payload,
+            }
+        return {
+            'compression': 'zlib',
+            'encrypted': encrypted,
+            'payload': payload,
+            'signature': str(base64.b64encode(plugins.basics.crypto.sign(self.privkey, payload)), 'ascii'),
+        }
+
+    def send(self, data):
+        """ Uploads a compressed batch to the master, returns True on success """
+        started = time.monotonic()
+        try:
+            rv = self.master.post('/api/node/results', json = self.pack(data))
+            if rv.status_code != 200:
+                raise Exception("Got status %u from warble master" % rv.status_code)
+        except Exception as err:
+            print("WARNING: Could not upload results: %s" % err)
+            self.failures += 1
+            return False
+        latency = time.monotonic() - started
+        self.lastlatency = latency
+        self.avglatency = latency if not self.batches else 0.9 * self.avglatency + 0.1 * latency
+        self.batches += 1
+        return True
+
+    def flush(self):
+        """ Sends up to one batch of queued reports to the master, returns True on success.
+            If the upload fails, the batch goes to the spool (or back in the queue if
+            we have no spool) to be sent later. """
+        with self.cond:
+            n = min(self.batch, len(self.queue))
+            items = [self.queue.popleft() for i in range(n)]
+        if not items:
+            return True
+        data = self.compress([x[1] for x in items])
+        if self.send(data):
+            self.sent += len(items)
+            return True
+        if self.spool is not None:
+            self.spool.append(data)
+            self.spooled += len(items)
+            self.spill()
+        else:
+            # Put the batch back at the front of the queue for the next attempt
+            with self.cond:
+                self.queue.extendleft(reversed(items))
+                while len(self.queue) > self.maxqueue:
+                    self.queue.popleft()
+                    self.dropped += 1
+        return False
+
+    def spill(self):
+        """ Moves everything queued to the spool, a batch at a time """
+        while True:
+            with self.cond:
+                n = min(self.batch, len(self.queue))
+                items = [self.queue.popleft() for i in range(n)]
+            if not items:
+                return
+            self.spool.append(self.compress([x[1] for x in items]))
+            self.spooled += len(items)
+
+    def replay(self):
+        """ Sends whatever has piled up in the spool, returns True if it's now empty """
+        if self.spool is None or not len(self.spool):
+            return True
+        n = self.spool.replay(self.send)
+        if n:
+            print("INFO: Replayed %u spooled result batches to the master" % n)
+        return not len(self.spool)
+
+    def stats(self):
+        """ Returns queue depth and flush statistics (latencies in seconds) """
+        return {
+            'queued': len(self.queue),
+            'sent': self.sent,
+            'batches': self.batches,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'spooled': self.spooled,
+            'spool': self.spool.size() if self.spool is not None else 0,
+            'latency': self.lastlatency,
+            'avglatency': self.avglatency,
+        }
+
+    def _due(self):
+        """ Returns how long until the next flush is due, 0 if it is due now, None if the queue is empty """
+        if not self.queue:
+            return None
+        if len(self.queue) >= self.batch:
+            return 0
+        return max(0, self.queue[0][0] + self.interval - time.monotonic())
+
+    def pause(self, seconds):
+        """ Waits for the master to get better, moving results to the spool
+            as they come in rather than letting the queue overflow """
+        deadline = time.monotonic() + seconds
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with self.cond:
+                if self.spool is None or len(self.queue) < self.batch:
+                    self.cond.wait(remaining)
+                full = len(self.queue) >= self.batch
+            if full and self.spool is not None:
+                self.spill()
+
+    def loop(self):
+        backoff = 0
+        while self.running:
+            with self.cond:
+                wait = self._due()
+                while self.running and wait != 0:
+                    if self.spool is not None and len(self.spool):
+                        # Don't wait for new results to replay the spool
+                        self.cond.wait(self.interval if wait is None else min(wait, self.interval))
+                        break
+                    self.cond.wait(wait)
+                    wait = self._due()
+            # Older results go out first
+            ok = self.replay()
+            if ok:
+                ok = self.flush()
+            elif self.spool is not None:
+                self.spill()
+            if ok:
+                backoff = 0
+            else:
+                # Master is unhappy, back off a bit before trying again
+                backoff = min(60, max(1, backoff * 2))
+                self.pause(backoff)
+        # Try to get whatever is left out the door before we go, or into the spool
+        if self.spool is not None and len(self.spool):
+            self.spill()
+        while self.queue:
+            if not self.flush() and self.spool is None:
+                break
+        if self.spool is not None:
+            self.spool.close()
+
+    def start(self):
+        """ Starts the uploader in a background thread """
+        self.running = True
+        self.thread = threading.Thread(target = self.loop, name = 'warble-uploader', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+def test():
+    """ Tests for the uploader: batches go to the spool while the master is
+        away, and reach it in order once it is back """
+    import tempfile
+    import plugins.basics.spool
+    class response():
+        def __init__(self, status_code):
+            self.status_code = status_code
+    class master():
+        def __init__(self):
+            self.up = False
+            self.received = []
+        def post(self, url, **kwargs):
+            if not self.up:
+                raise Exception("Master is down")
+            self.received.extend(x['task'] for x in json.loads(zlib.decompress(base64.b64decode(kwargs['json']['payload']))))
+            return response(200)
+    with tempfile.TemporaryDirectory() as path:
+        m = master()
+        s = plugins.basics.spool.spool(path)
+        u = uploader({'client': {}}, m, plugins.basics.crypto.keypair(2048), batch = 10, interval = 50, maxqueue = 25, spool = s)
+        u.start()
+        for i in range(200):
+            u.put({'task': i})
+            time.sleep(0.002)
+        # The queue only holds 25, so all but the last partial batch must have gone to disk
+        deadline = time.monotonic() + 5
+        while u.spooled + len(u.queue) < 200 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert(u.dropped == 0)
+        assert(u.spooled + len(u.queue) == 200 and len(u.queue) < u.batch and s.size() > 0)
+        m.up = True
+        deadline = time.monotonic() + 10
+        while len(m.received) < 200 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        u.stop()
+        assert(m.received == list(range(200)))
+        assert(len(s) == 0)
+    print("Uploader works as intended!")
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" This is the multi-process worker pool for Apache Warble (incubating)
+    nodes. One Python process can only keep about one CPU core busy, so
+    larger nodes split their task list across several worker processes,
+    each with its own scheduler and executor. Tasks are assigned to
+    workers on a consistent hash ring, so a change to the task list only
+    moves the tasks that were added or removed. Finished reports come back
+    to the main process through a shared memory ring buffer per worker,
+    and are handed on to the uploader from there.
+"""
+
+import bisect
+import json
+import multiprocessing
+import multiprocessing.shared_memory
+import queue
+import struct
+import threading
+import time
+import zlib
+
+# Shared memory layout: a header with the ring buffer positions and the
+# worker's statistics, followed by the ring buffer itself.
+HEADER = struct.Struct('!QQQQddQQ') # head, tail, dropped, completed, avglag, maxlag, fired, skipped
+HEADERSIZE = 64
+WRAP = 0xFFFFFFFF # Length marker meaning "continue at the start of the buffer"
+
+class ring():
+    """ Consistent hash ring mapping keys to worker numbers """
+    def __init__(self, nodes, replicas = 64):
+        self.points = []
+        self.owners = []
+        for point, node in sorted((self.hash("%u-%u" % (node, i)), node) for node in range(nodes) for i in range(replicas)):
+            self.points.append(point)
+            self.owners.append(node)
+
+    def hash(self, key):
+        return zlib.crc32(str(key).encode('utf-8'))
+
+    def lookup(self, key):
+        """ Returns the worker number owning a key """
+        i = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[i]
+
+class channel():
+    """ A single-producer, single-consumer ring buffer in shared memory.
+        The worker appends length-prefixed records, the main process
+        reads them off. Positions only ever grow, and are taken modulo the
+        buffer size when accessing it. """
+    def __init__(self, name = None, size = 4 * 1024 * 1024):
+        if name:
+            self.shm = multiprocessing.shared_memory.SharedMemory(name = name)
+        else:
+            self.shm = multiprocessing.shared_memory.SharedMemory(create = True, size = HEADERSIZE + size)
+            self.shm.buf[:HEADERSIZE] = bytes(HEADERSIZE)
+        self.name = self.shm.name
+        self.size = self.shm.size - HEADERSIZE
+        self.buf = self.shm.buf
+        self.lock = threading.Lock() # Worker side: many probe threads share one producer slot
+
+    def _get(self, offset):
+        return struct.unpack_from('!Q', self.buf, offset)[0]
+
+    def _set(self, offset, value):
+        struct.pack_into('!Q', self.buf, offset, value)
+
+    def write(self, data, timeout = 5):
+        """ Appends a record, waiting up to timeout seconds for room.
+            Returns False (and counts it as dropped) if there was none. """
+        need = 4 + len(data)
+        if need > self.size // 2:
+            raise ValueError("Record of %u bytes too large for result channel" % len(data))
+        with self.lock:
+            tail = self._get(8)
+            pos = tail % self.size
+            pad = self.size - pos if pos + need > self.size else 0
+            deadline = time.monotonic() + timeout
+            while tail + pad + need - self._get(0) > self.size:
+                if time.monotonic() > deadline:
+                    self._set(16, self._get(16) + 1)
+                    return False
+                time.sleep(0.001)
+            if pad:
+                if pad >= 4:
+                    struct.pack_into('!I', self.buf, HEADERSIZE + pos, WRAP)
+                tail += pad
+                pos = 0
+            struct.pack_into('!I', self.buf, HEADERSIZE + pos, len(data))
+            self.buf[HEADERSIZE + pos + 4:HEADERSIZE + pos + need] = data
+            # Publish the record only once it is fully written
+            self._set(8, tail + need)
+            self._set(24, self._get(24) + 1)
+            return True
+
+    def read(self):
+        """ Returns a list of all records waiting in the buffer """
+        head = self._get(0)
+        tail = self._get(8)
+        records = []
+        while head < tail:
+            pos = head % self.size
+            left = self.size - pos
+            if left < 4:
+                head += left
+                continue
+            length = struct.unpack_from('!I', self.buf, HEADERSIZE + pos)[0]
+            if length == WRAP:
+                head += left
+                continue
+            records.append(bytes(self.buf[HEADERSIZE + pos + 4:HEADERSIZE + pos + 4 + length]))
+            head += 4 + length
+        self._set(0, head)
+        return records
+
+    def setstats(self, lag):
+        """ Publishes the worker's scheduler statistics """
+        struct.pack_into('!ddQQ', self.buf, 32, lag['average'], lag['max'], lag['fired'], lag['skipped'])
+
+    def stats(self):
+        head, tail, dropped, completed, avglag, maxlag, fired, skipped = HEADER.unpack_from(self.buf, 0)
+        return {
+            'pending': tail - head,
+            'dropped': dropped,
+            'completed': completed,
+            'average': avglag,
+            'max': maxlag,
+            'fired': fired,
+            'skipped': skipped,
+        }
+
+    def close(self, unlink = False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+def main(index, config, name, inbox, workers, pertarget):
+    """ Worker process entry point: runs the tasks we are sent, and writes
+        their reports to our result channel """
+    import plugins.basics.certs
+    import plugins.basics.executor
+    import plugins.basics.scheduler
+    if config.get('certs', {}).get('path'):
+        plugins.basics.certs.shared.open(config['certs']['path'])
+    results = channel(name = name)
+    def report(task, t):
+        results.write(t.report.dumps(task = task.get('id')))
+    executor = plugins.basics.executor.executor(config, workers = workers, pertarget = pertarget, maxpending = config.get('executor', {}).get('maxpending', 256))
+    scheduler = plugins.basics.scheduler.scheduler(config, lambda task: executor.submit(task, report),
+                                                   grouper = executor.group, batch = lambda tasks: executor.submitgroup(tasks, report),
+                                                   backlog = executor.lag)
+    scheduler.start()
+    timeout = 30
+    stopping = False
+    def control(cmd, arg):
+        """ Handles a command other than the task list itself """
+        nonlocal timeout, stopping
+        if cmd == 'offset':
+            config['misc']['offset'] = arg
+        elif cmd == 'stop':
+            timeout = arg
+            stopping = True
+    def drain():
+        """ Yields tasks from the inbox until the end of the task list """
+        while not stopping:
+            cmd, arg = inbox.get()
+            if cmd == 'end':
+                return
+            if cmd == 'tasks':
+                yield from arg
+            else:
+                control(cmd, arg)
+    try:
+        while not stopping:
+            try:
+                cmd, arg = inbox.get(timeout = 1)
+            except queue.Empty:
+                results.setstats(scheduler.lag())
+                continue
+            if cmd == 'begin':
+                scheduler.update(drain())
+            else:
+                control(cmd, arg)
+    except KeyboardInterrupt:
+        pass
+    # Let whatever is running finish and get its report out
+    scheduler.stop()
+    executor.wait(timeout)
+    executor.shutdown(wait = False)
+    plugins.basics.certs.shared.save()
+    results.setstats(scheduler.lag())
+    results.close()
+
+class pool():
+    def __init__(self, globalConfig, callback, processes = 4, workers = 64, pertarget = 4, grouper = None, buffersize = 4 * 1024 * 1024):
+        self.config = json.loads(json.dumps(globalConfig)) # Plain copy we can hand to other processes
+        self.callback = callback # Called with each finished report, as serialized JSON
+        self.processes = processes
+        self.workers = workers # Probe threads per process
+        self.pertarget = pertarget # Per target limit, per process
+        self.grouper = grouper # Tasks in the same group go to the same worker, so they can share connections
+        self.context = multiprocessing.get_context('spawn')
+        self.ring = ring(processes)
+        self.channels = [channel(size = buffersize) for i in range(processes)]
+        self.inboxes = [None] * processes
+        self.procs = [None] * processes
+        self.assigned = [{} for i in range(processes)] # worker -> {task id: task}
+        self.restarts = [0] * processes
+        self.received = [0] * processes
+        self.lastcount = [0] * processes
+        self.lasttime = time.monotonic()
+        self.lock = threading.Lock()
+        self.running = False
+        self.threads = []
+
+    def owner(self, task):
+        """ Returns the number of the worker a task belongs to """
+        key = self.grouper(task) if self.grouper else None
+        return self.ring.lookup(task.get('id') if key is None else key)
+
+    def _spawn(self, i):
+        self.inboxes[i] = self.context.Queue()
+        proc = self.context.Process(target = main, name = 'warble-worker-%u' % i, daemon = True,
+                                    args = (i, self.config, self.channels[i].name, self.inboxes[i], self.workers, self.pertarget))
+        proc.start()
+        self.procs[i] = proc
+        self._send(i)
+
+    def _send(self, i, chunk = 256):
+        """ Sends a worker its complete task list """
+        tasks = list(self.assigned[i].values())
+        inbox = self.inboxes[i]
+        inbox.put( ('begin', None) )
+        for n in range(0, len(tasks), chunk):
+            inbox.put( ('tasks', tasks[n:n+chunk]) )
+        inbox.put( ('end', None) )
+
+    def start(self):
+        """ Starts the worker processes and the result collector """
+        self.running = True
+        for i in range(self.processes):
+            self._spawn(i)
+        for target, name in ( (self.collect, 'warble-results'), (self.monitor, 'warble-monitor') ):
+            thread = threading.Thread(target = target, name = name, daemon = True)
+            thread.start()
+            self.threads.append(thread)
+
+    def update(self, tasks, chunk = 256):
+        """ Syncs the workers with a fresh task list from the master, passing
+            tasks on in chunks as they come in """
+        assigned = [{} for i in range(self.processes)]
+        buffers = [[] for i in range(self.processes)]
+        with self.lock:
+            inboxes = list(self.inboxes)
+            for inbox in inboxes:
+                if inbox:
+                    inbox.put( ('begin', None) )
+        def flush(i):
+            with self.lock:
+                # A worker restarted meanwhile gets the whole list again below
+                if inboxes[i] and self.inboxes[i] is inboxes[i]:
+                    inboxes[i].put( ('tasks', buffers[i]) )
+            buffers[i] = []
+        for task in tasks:
+            i = self.owner(task)
+            assigned[i][task.get('id')] = task
+            buffers[i].append(task)
+            if len(buffers[i]) >= chunk:
+                flush(i)
+        for i in range(self.processes):
+            if buffers[i]:
+                flush(i)
+        with self.lock:
+            for i in range(self.processes):
+                self.assigned[i] = assigned[i]
+                if inboxes[i] and self.inboxes[i] is inboxes[i]:
+                    inboxes[i].put( ('end', None) )
+                elif self.procs[i]:
+                    self._send(i)
+
+    def setoffset(self, offset):
+        """ Tells the workers about a new NTP time offset """
+        with self.lock:
+            self.config['misc']['offset'] = offset
+            for inbox in self.inboxes:
+                if inbox:
+                    inbox.put( ('offset', offset) )
+
+    def __len__(self):
+        return sum(len(x) for x in self.assigned)
+
+    def collect(self):
+        """ Reads reports off the worker channels and passes them on """
+        idle = 0.001
+        while self.running:
+            n = 0
+            for i, results in enumerate(self.channels):
+                for record in results.read():
+                    n += 1
+                    self.received[i] += 1
+                    try:
+                        self.callback(record)
+                    except Exception as err:
+                        print("ALERT: Could not process result from worker %u: %s" % (i, err))
+            # Poll more slowly while the workers are quiet
+            idle = 0.001 if n else min(0.05, idle * 2)
+            time.sleep(idle)
+
+    def monitor(self):
+        """ Restarts workers that died on us """
+        while self.running:
+            time.sleep(1)
+            with self.lock:
+                for i, proc in enumerate(self.procs):
+                    if self.running and proc and not proc.is_alive():
+                        print("WARNING: Worker process %u exited with code %s, restarting it" % (i, proc.exitcode))
+                        self.restarts[i] += 1
+                        self._spawn(i)
+
+    def _stop(self, i, timeout):
+        """ Asks a worker to finish up and exit, kills it if it won't """
+        proc = self.procs[i]
+        if not proc:
+            return
+        self.inboxes[i].put( ('stop', timeout) )
+        proc.join(timeout + 5)
+        if proc.is_alive():
+            print("WARNING: Worker process %u did not stop in time, terminating it" % i)
+            proc.terminate()
+            proc.join()
+        self.procs[i] = None
+
+    def restart(self, i = None, timeout = 30):
+        """ Gracefully restarts one worker, or all of them one at a time """
+        for n in (range(self.processes) if i is None else [i]):
+            with self.lock:
+                self._stop(n, timeout)
+                self.restarts[n] += 1
+                self._spawn(n)
+
+    def stop(self, timeout = 30):
+        with self.lock:
+            self.running = False
+            for i in range(self.processes):
+                self._stop(i, timeout)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        # Pick up the last reports, then release the shared memory
+        for i, results in enumerate(self.channels):
+            for record in results.read():
+                self.received[i] += 1
+                self.callback(record)
+            results.close(unlink = True)
+
+    def lag(self):
+        """ Returns scheduler lag statistics across all workers, in seconds """
+        stats = [x.stats() for x in self.channels]
+        return {
+            'last': 0.0,
+            'average': max(x['average'] for x in stats),
+            'max': max(x['max'] for x in stats),
+            'fired': sum(x['fired'] for x in stats),
+            'skipped': sum(x['skipped'] for x in stats),
+            'scheduled': len(self),
+        }
+
+    def stats(self):
+        """ Returns per-worker statistics, with throughput in reports per second since the last call """
+        now = time.monotonic()
+        elapsed = max(0.001, now - self.lasttime)
+        self.lasttime = now
+        rv = []
+        for i, results in enumerate(self.channels):
+            s = results.stats()
+            proc = self.procs[i]
+            s.update({
+                'worker': i,
+                'pid': proc.pid if proc else None,
+                'tasks': len(self.assigned[i]),
+                'received': self.received[i],
+                'rate': (self.received[i] - self.lastcount[i]) / elapsed,
+                'restarts': self.restarts[i],
+            })
+            self.lastcount[i] = self.received[i]
+            rv.append(s)
+        return rv
+
+def test():
+    """ Tests for the result channel and the hash ring """
+    # Records of all sizes, wrapping around a small buffer many times over
+    ours = channel(size = 1024)
+    theirs = channel(ours.name)
+    records = [bytes([i % 256]) * (i * 7 % 300) for i in range(2000)]
+    def produce():
+        for record in records:
+            assert(theirs.write(record))
+    t = threading.Thread(target = produce)
+    t.start()
+    got = []
+    while t.is_alive() or ours.stats()['pending']:
+        got += ours.read()
+    t.join()
+    assert(got == records)
+    stats = ours.stats()
+    assert(stats['completed'] == len(records) and stats['dropped'] == 0 and stats['pending'] == 0)
+    # A full buffer drops records rather than blocking forever
+    while theirs.write(b"x" * 100, timeout = 0):
+        pass
+    assert(ours.stats()['dropped'] == 1)
+    assert(len(ours.read()) == ours.stats()['completed'] - len(records))
+    try:
+        theirs.write(b"x" * 600)
+        assert(False)
+    except ValueError:
+        pass
+    theirs.setstats({'average': 0.5, 'max': 2.0, 'fired': 10, 'skipped': 1})
+    assert(ours.stats()['max'] == 2.0 and ours.stats()['skipped'] == 1)
+    theirs.close()
+    ours.close(unlink = True)
+    # Adding a worker only moves the keys it takes over
+    before = ring(4)
+    after = ring(5)
+    keys = ["https://www.example.org/%u" % i for i in range(10000)]
+    moved = [k for k in keys if before.lookup(k) != after.lookup(k)]
+    assert(all(after.lookup(k) == 4 for k in moved))
+    assert(1000 < len(moved) < 3000)
+    print("Worker result channel works as intended!")
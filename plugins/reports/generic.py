@@ -17,50 +17,214 @@
 
 """
 This is the generic node report class for Apache Warble (incubating)
+
+Nodes produce a lot of these, so they are kept small: no per-report
+dicts or lists until something actually needs one, the known test
+phases are stored by number in a fixed array of timestamps, and debug
+messages go into a small ring buffer and are only formatted when the
+report is looked at. Unless configured otherwise, only failed checks
+upload their debug log, so successful ones cost next to nothing.
+
+Timing uses the monotonic nanosecond performance counter, so phase
+durations are exact and don't jump when the system clock is adjusted.
+Each report takes one NTP-corrected wall clock reading when it is made,
+and all its timestamps are worked out from that anchor.
 """
 
+import array
+import json
+import os
 import time
-import plugins.basics.misc
 import uuid
 
+# Known test phases, in the order they usually happen. Timers for any
+# other tag end up in a (lazily created) dict instead.
+PHASES = ('init', 'dns', 'connect', 'send', 'read', 'headers', 'data', 'end')
+PHASEID = {tag: i for i, tag in enumerate(PHASES)}
+EMPTY = array.array('q', [-1]) * len(PHASES) # -1 means "not reached"
+
+# Log levels, as in the logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+
+# Log args of these types are kept as they are, anything else as str()
+PLAIN = frozenset( (str, int, float, bool) )
+
+# Reusing one encoder is a good deal faster than json.dumps() with options
+encoder = json.JSONEncoder(separators = (',', ':'), check_circular = False)
+
+_settings = (None, None) # Last config seen, and its log settings
+
+def settings(globalConfig):
+    """ Returns (minimum level, ring buffer size, which reports upload their log) """
+    global _settings
+    if _settings[0] is not globalConfig:
+        rconf = globalConfig.get('reports') or {}
+        _settings = (globalConfig, (LEVELS.get(rconf.get('loglevel', 'debug'), DEBUG), max(1, rconf.get('logsize', 32)), rconf.get('uploadlog', 'errors')))
+    return _settings[1]
+
 class template:
+    __slots__ = ('_id', '_debug', '_count', '_warn', '_alert', '_error', '_times', '_extra', '_details', 'anchor', 'base', 'verbose', 'logging')
     
     def __init__(self, globalConfig):
-        self._debug = [] # Generic debug array with tuples in it
-        self._warn = [] # Generic warning array with tuples in it
-        self._alert = [] # Generic alert array with tuples in it
+        self._id = None # Report ID, made on first use
+        self._debug = None # Ring buffer of log records: (ns, level, message, format args)
+        self._count = 0 # Number of log records ever written to the ring
+        self._warn = None # Warnings: (ns, message)
+        self._alert = None # Alerts: (ns, message)
         self._error = None # Error placeholder
-        self.timeseries = {} # Generic dictionary timeseries
-        self.id = uuid.uuid4() # Report ID
-        self.config = globalConfig
-        self.offset = globalConfig['misc'].get('offset', 0) # timestamp offset
-        
-    def debug(self, string):
+        self._times = EMPTY[:] # ns into the test at which each known phase was reached
+        self._extra = None # Same, for any other phases
+        self._details = None # Key/value details about the test (address used etc)
+        # Wall clock (NTP adjusted) and monotonic time at the start of the test, in ns
+        self.anchor = time.time_ns() - int(globalConfig['misc'].get('offset', 0) * 1e9)
+        self.base = time.perf_counter_ns()
+        self.verbose = globalConfig.get('debug', False) == True
+        self.logging = settings(globalConfig)
+    
+    @property
+    def id(self):
+        if self._id is None:
+            self._id = uuid.UUID(bytes = os.urandom(16), version = 4)
+        return self._id
+    
+    def now(self):
+        """ Returns the number of ns since the start of the test """
+        return time.perf_counter_ns() - self.base
+    
+    def walltime(self, ns):
+        """ Turns ns since the start of the test into a timestamp """
+        return (self.anchor + ns) / 1e9
+    
+    def phases(self):
+        """ Returns (phase, ns since the start of the test) for every phase reached, in order """
+        times = [(tag, t) for tag, t in zip(PHASES, self._times) if t >= 0]
+        if self._extra:
+            times.extend(self._extra.items())
+        times.sort(key = lambda x: x[1])
+        return times
+    
+    @property
+    def timeseries(self):
+        """ Phase name -> timestamp, for every phase reached """
+        return {tag: self.walltime(t) for tag, t in self.phases()}
+    
+    @property
+    def durations(self):
+        """ Phase name -> microseconds since the phase before it (or since the start of the test) """
+        return self._durations(self.phases())
+    
+    def _durations(self, phases):
+        durations = {}
+        previous = 0
+        for tag, t in phases:
+            durations[tag] = (t - previous) / 1000
+            previous = t
+        return durations
+    
+    @property
+    def details(self):
+        if self._details is None:
+            self._details = {}
+        return self._details
+    
+    def record(self, level, string, args):
+        """ Logs a message in the report's ring buffer, if it is at or above
+            the configured level. Any args are %-formatted into the string,
+            but only if someone reads it. """
+        if level < self.logging[0]:
+            if self.verbose:
+                print(string % args if args else string)
+            return
+        for x in args:
+            if type(x) not in PLAIN:
+                # Don't keep other objects (exceptions with their tracebacks, sockets...) alive in the report
+                args = tuple(x if type(x) in PLAIN else str(x) for x in args)
+                break
+        entry = (self.now(), level, string, args)
+        if self._debug is None:
+            self._debug = [entry]
+        elif len(self._debug) < self.logging[1]:
+            self._debug.append(entry)
+        else:
+            self._debug[self._count % self.logging[1]] = entry
+        self._count += 1
+        if self.verbose:
+            print(string % args if args else string)
+    
+    def debug(self, string, *args):
         """ Logs a debug string in the report with a timestamp """
-        now = time.time() - self.offset
-        self._debug.append( (now, string) )
-        if self.config.get('debug', False) == True:
-            print(string)
+        self.record(DEBUG, string, args)
+    
+    def info(self, string, *args):
+        """ Logs an informational string in the report with a timestamp """
+        self.record(INFO, string, args)
+    
+    def log(self):
+        """ Returns the last (up to ring buffer size) log records, oldest
+            first, as a list of (timestamp, message) """
+        if not self._debug:
+            return []
+        # Once the ring is full, the oldest record is the one we'd overwrite next
+        start = self._count % len(self._debug)
+        records = self._debug[start:] + self._debug[:start]
+        return [(self.walltime(t), string % args if args else string) for t, level, string, args in records]
         
     def error(self, tag, string):
         self._error = {
-            'time': time.time() - self.offset,
+            'time': self.walltime(self.now()),
             'component': tag,
             'message': string
         }
         
     def warn(self, string):
         """ Logs a warning message """
-        now = time.time() - self.offset
-        self._warn.append( (now, string) )
+        if self._warn is None:
+            self._warn = []
+        self._warn.append( (self.now(), string) )
     
     def alert(self, string):
         """ Logs an alert message """
-        now = time.time() - self.offset
-        self._alert.append( (now, string) )
+        if self._alert is None:
+            self._alert = []
+        self._alert.append( (self.now(), string) )
+    
+    def note(self, key, value):
+        """ Records a detail about the test, such as the address connected to """
+        self.details[key] = value
     
     def timer(self, tag):
         """ Logs an event in a timeseries list """
-        now = time.time() - self.offset
-        self.timeseries[tag] = now
+        now = self.now()
+        i = PHASEID.get(tag)
+        if i is not None:
+            self._times[i] = now
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[tag] = now
+    
+    def export(self):
+        """ Returns the report as a JSON-serializable dict for uploading """
+        phases = self.phases()
+        return {
+            'id': str(self.id),
+            'error': self._error,
+            'timeseries': {tag: self.walltime(t) for tag, t in phases},
+            'durations': self._durations(phases),
+            'details': self._details or {},
+            'warnings': [(self.walltime(t), string) for t, string in self._warn or ()],
+            'alerts': [(self.walltime(t), string) for t, string in self._alert or ()],
+            'debug': self.log() if self.logging[2] == 'all' or (self._error and self.logging[2] == 'errors') else [],
+        }
     
+    def dumps(self, **extra):
+        """ Returns the report serialized as compact JSON (bytes), with any
+            extra keys (such as the task id) added at the top level """
+        data = self.export()
+        if extra:
+            data.update(extra)
+        return encoder.encode(data).encode('utf-8')
@@ -1,6 +1,23 @@
-import plugins.tests.tcp
-import plugins.tests.http
-import plugins.tests.smtp
+""" This is the test plugin registry for Apache Warble (incubating)
+    nodes. Test plugins are found without importing them: every module in
+    this directory is a plugin for the task type of the same name, and
+    third party packages can add their own through the 'warble.tests'
+    entry point group (name = task type, value = module with a test class).
+    A plugin is only imported when a task of its type first shows up, so
+    nodes only pay for the test types they actually run.
+"""
+
+import importlib
+import os
+import threading
+import time
+
+ENTRY_POINTS = 'warble.tests'
+
+# Task types handled by a plugin of a different name
+ALIASES = {
+    'https': 'http',
+}
 
 __all__ = [
     'tcp',
@@ -8,3 +25,75 @@ __all__ = [
     'smtp'
 ]
 
+class registry():
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.plugins = {} # task type -> module name or entry point, not loaded yet
+        self.modules = {} # task type -> loaded module
+        self.loadtimes = {} # task type -> seconds it took to import
+        self.scanned = False # Have we looked at the entry points yet?
+        path = os.path.dirname(os.path.realpath(__file__))
+        for filename in sorted(os.listdir(path)):
+            name, ext = os.path.splitext(filename)
+            if ext == '.py' and not name.startswith('_'):
+                self.plugins[name] = 'plugins.tests.' + name
+        for alias, name in ALIASES.items():
+            if name in self.plugins:
+                self.plugins[alias] = self.plugins[name]
+
+    def _scan(self):
+        """ Looks for third party plugins, built-in ones take precedence """
+        self.scanned = True
+        try:
+            import importlib.metadata
+            for ep in importlib.metadata.entry_points(group = ENTRY_POINTS):
+                if ep.name not in self.plugins:
+                    self.plugins[ep.name] = ep
+        except Exception as err:
+            print("WARNING: Could not look for test plugins: %s" % err)
+
+    def types(self):
+        """ Returns every known task type, loaded or not """
+        with self.lock:
+            if not self.scanned:
+                self._scan()
+            return sorted(self.plugins)
+
+    def get(self, ttype):
+        """ Returns the test module for a task type, importing it if need be """
+        module = self.modules.get(ttype)
+        if module:
+            return module
+        with self.lock:
+            module = self.modules.get(ttype)
+            if module:
+                return module
+            if ttype not in self.plugins and not self.scanned:
+                self._scan()
+            plugin = self.plugins.get(ttype)
+            if plugin is None:
+                raise Exception("Unknown test type '%s'" % ttype)
+            started = time.perf_counter()
+            if isinstance(plugin, str):
+                module = importlib.import_module(plugin)
+            else:
+                module = plugin.load()
+            # Aliases share the module, and the time it took to load it
+            for name, other in self.plugins.items():
+                if other is plugin:
+                    self.modules[name] = module
+            self.loadtimes[ttype] = time.perf_counter() - started
+            return module
+
+    def stats(self):
+        """ Returns the load time of every plugin loaded so far, in seconds """
+        return dict(self.loadtimes)
+
+# Shared plugin registry for this node
+shared = registry()
+
+def __getattr__(name):
+    """ Lets plugins.tests.tcp and friends work without importing all plugins up front """
+    if name in shared.plugins and isinstance(shared.plugins[name], str) and name not in ALIASES:
+        return shared.get(name)
+    raise AttributeError("module 'plugins.tests' has no attribute '%s'" % name)
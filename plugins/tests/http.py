@@ -21,8 +21,11 @@ This is the HTTP(S) test suite for Apache Warble (incubating).
 
 import plugins.basics
 import plugins.reports
+import plugins.basics.certs
+import plugins.basics.httpparser
+import plugins.basics.matcher
 import ssl
-import re
+import time
 
 class test:
     def __init__(self, globalConfig):
@@ -30,147 +33,250 @@ class test:
         # Initialize a report object to store our findings
         self.report = plugins.reports.generic.template(self.config)
     
-    def getCertData(cert):
-        """ Collates certificate data for HTTPS checks """
-        cn = ["none"]
-        ou = ["none"]
-        on = ["none"]
-        if 'subjectAltName' in cert:
-            cn = [x[1] for x in cert['subjectAltName']
-                         if x[0].lower() == 'dns']
-        else:
-            cn =  [x[0][1] for x in cert['subject']
-                            if x[0][0].lower() == 'commonname']
-        ou =  [x[0][1] for x in cert['subject']
-                            if x[0][0].lower() == 'organizationalunitname']
-        on =  [x[0][1] for x in cert['subject']
-                            if x[0][0].lower() == 'organizationname']
-        return ("O=%s/OU=%s/CN=%s" % (str(on[0]) if len(on) > 0 else "Unknown", str(ou[0]) if len(ou) > 0 else "Unknown", str(cn[0]) if len(cn) > 0 else "Unknown"))
+    def receive(self, request, response, until):
+        """ Feeds data from the socket into the response parser until the condition is met """
+        reader = request.reader()
+        while not until():
+            view = reader.peek()
+            if not len(view):
+                view.release()
+                response.eof()
+                break
+            n = response.feed(view)
+            view.release()
+            reader.skip(n)
     
-            
-    def run(self, testParameters):
-        request = plugins.basics.socket.tcp(testParameters, self.report)
+    def setup(self, request, testParameters):
+        """ Connects to the host and sets up TLS if needed. Returns False if the test failed """
+        pid = testParameters.get('id')
+        SSL = True if testParameters.get('type') == "https" else False # SSL/TLS request?
+        vhost = testParameters.get('vhost', testParameters.get('host', 'localhost'))
         
+        # Try to connect, if fail, report and return
         try:
-            # Basic initialization and settings
-            pid = testParameters.get('id')
-            try:
-                request.init(testParameters)
-            except Exception as err:
-                self.report.error('init', str(err))
-            
-            SSL = True if testParameters.get('type') == "https" else False # SSL/TLS request?
-            ise = testParameters.get('ise', 999) # Which status code(s) to treat as Internal Server Error/failure
-            method = testParameters.get('method', 'GET')
-            vhost = testParameters.get('vhost', testParameters.get('host', 'localhost'))
+            request.connect()
+        except Exception as err:
+            self.report.error('connect', str(err))
+            return False
+        
+        # If SSL/TLS, initiate OpenSSL context
+        if SSL:
+            # Hope for a vhost setting, fall back to host name or 'localhost'
+            request.secure(SNI = vhost, verify = testParameters.get('checkcert', False), resume = testParameters.get('resume', True))
             
-            # Try to connect, if fail, report and return
-            try:
-                request.connect()
-            except Exception as err:
-                self.report.error('connect', str(err))
-                return report
+            self.report.debug("Connected, sending HTTPS payload.")
+            request.cert = {}
             
-            # If SSL/TLS, initiate OpenSSL context
-            if SSL:
-                context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2) # SSL, TLS1, TLS1.1 is largely deprecated now.
-                context.verify_mode = ssl.CERT_OPTIONAL
-                # Are we going to test the certificate for validity?
+            cipher = request.socket.cipher()
+            request.cert['protocol'] = cipher[1]
+            request.cert['algorithm'] = cipher[0]
+            # Certificates are parsed once and then looked up by fingerprint
+            fp, entry = plugins.basics.certs.shared.lookup(request.socket)
+            if entry:
+                self.report.debug("Analyzing server certificate %s", fp)
+                request.cert['fingerprint'] = fp
+                request.cert['notbefore'] = entry['notbefore']
+                request.cert['notafter'] = entry['notafter']
+                request.cert['subject'] = entry['subject']
+                request.cert['issuer'] = entry['issuer']
+                self.report.note('certificate', fp)
+                now = time.time() - self.config['misc'].get('offset', 0)
+                left = plugins.basics.certs.shared.expiry(entry, now)
                 if testParameters.get('checkcert', False) == True:
-                    context.verify_mode = ssl.CERT_REQUIRED
-                context.check_hostname = True
-                context.load_default_certs()
-                
-                # Hope for a vhost setting, fall back to host name or 'localhost'
-                request.socket = context.wrap_socket(sock.socket, server_hostname = vhost)
-                
-                self.report.debug("Connected, sending HTTPS payload.")
-                request.cert = {}
-                
-                cert = request.socket.getpeercert(binary_form=False)
-                cipher = request.socket.cipher()
-                request.cert['protocol'] = cipher[1]
-                request.cert['algorithm'] = cipher[0]
-                if cert:
-                    self.report.debug("Analyzing server certificate")
-                    request.cert['notbefore'] = cert['notBefore'] if 'notBefore' in cert else None
-                    request.cert['notafter'] = cert['notAfter']
-                    request.cert['subject'] = self.getCertData(cert)
-                    request.cert['issuer'] = "Validated Certificate Authority"
-                    now = time.time() - toffset
-                    if not pid in certDates or certDates[pid] <= (now - (86400)):
-                        self.report.debug("Saving certificate data")
-                    if testParameters.get('checkcert', False) == True:
-                        first = ssl.cert_time_to_seconds(cert['notBefore'])
-                        last = ssl.cert_time_to_seconds(cert['notAfter'])
-                        if first > now:
-                            self.report.error('certificate', "HTTPS certificate is not yet valid (notBefore is greater than today)")
-                            return
-                        if last < now:
-                            self.report.error('certificate', "HTTPS certificate has expired (notAfter is less than today)")
-                            return
-                    if testParameters.get('warncert', False) == True:
-                        last = ssl.cert_time_to_seconds(cert['notAfter'])
-                        if last < (time.time() + (86400*7)):
-                            days = int((last - time.time()) / 86400)
-                            self.report.error('certificate', "HTTPS certificate is about to expire (%u days from now)!" % days)
-                            return
+                    if entry['notbefore'] and entry['notbefore'] > now:
+                        self.report.error('certificate', "HTTPS certificate is not yet valid (notBefore is greater than today)")
+                        return False
+                    if left < 0:
+                        self.report.error('certificate', "HTTPS certificate has expired (notAfter is less than today)")
+                        return False
+                if testParameters.get('warncert', False) == True:
+                    if left < (86400*7):
+                        self.report.error('certificate', "HTTPS certificate is about to expire (%u days from now)!" % max(0, left // 86400))
+                        return False
+
+        else:
+            self.report.debug("Connected, sending HTTP payload.")
+        return True
     
-            else:
-                self.report.debug("Connected, sending HTTP payload.")
-            request.send("%s %s HTTP/1.1\r\nConnection: close\r\nHost: %s\r\nUser-Agent: Apache Warble/%s\r\n\r\n" % (method.upper(), testParameters.get('uri', '/'), vhost, self.config.get('version')))
-            self.report.timer('send')
-            status = None
-            ISE = None
-            self.report.debug("Reading response header from server")
-            for line in request.readline():
-                line = str(line, 'utf-8')
-                if not status:
-                    self.report.timer('read')
-                    match = re.match("HTTP/[0-9.]+ (\d+)(.*)", line, flags=re.I)
-                    if match:
-                        rc = int(match.group(1))
-                        request.status_code = match.group(1) + match.group(2)
-                        self.report.debug("Server response code: %s" % request.status_code)
-                        if rc > ise and ise > 0:
-                            ISE = line
-                        status = True
-                    else:
-                        raise Exception("Invalid HTTP response received: " + line)
-                    if not request.status_code:
-                        request.status_code = line
-                if line == "" or line == "\r":
-                    break
-                match = re.match("Server: (.+)", line, flags=re.I)
-                if match:
-                    request.server = match.group(1)
-                    self.report.debug("Server software is: %s" % request.server)
-                match = re.match("Location: (.+)", line, flags=re.I)
-                if match:
-                    request.location = match.group(1)
-            
-            # Did we catch an internal server error or equivalent? bork!
-            if ISE:
-                self.report.error('response', "Internal Server Error or equivalent bad message received: " + ISE)
-                return
-            
-            self.report.debug("Reading response body (up to 10kb)")
-            data = ""
-            while len(data) < 10240:
-                try:
-                    bucket = request.socket.recv(1024)
-                    if not bucket:
-                        break
-                    data += bucket
-                except Exception as err:
-                    break
+    def send(self, request, testParameters, close = True):
+        """ Sends the HTTP request, asking the server to close the connection afterwards unless close is False """
+        method = testParameters.get('method', 'GET')
+        vhost = testParameters.get('vhost', testParameters.get('host', 'localhost'))
+        request.send("%s %s HTTP/1.1\r\nConnection: %s\r\nHost: %s\r\nUser-Agent: Apache Warble/%s\r\n\r\n" % (method.upper(), testParameters.get('uri', '/'), 'close' if close else 'keep-alive', vhost, self.config.get('version')))
+        self.report.timer('send')
+    
+    def matcher(self, testParameters):
+        """ Returns a content matcher for the body checks in the task, or None if there are none """
+        def aslist(value):
+            if not value:
+                return []
+            return [value] if isinstance(value, str) else list(value)
+        contains = aslist(testParameters.get('contains'))
+        excludes = aslist(testParameters.get('excludes'))
+        regex = aslist(testParameters.get('regex'))
+        digest = testParameters.get('digest', False) == True or bool(testParameters.get('sha256'))
+        if not (contains or excludes or regex or digest):
+            return None
+        return plugins.basics.matcher.matcher(contains, excludes, regex, digest = digest)
+    
+    def collect(self, request, testParameters):
+        """ Reads and checks the response to our request, returns the parsed response """
+        ise = testParameters.get('ise', 999) # Which status code(s) to treat as Internal Server Error/failure
+        ISE = None
+        # Without any content checks we only look at the first 10kb, with them at up to 8mb
+        matcher = self.matcher(testParameters)
+        maxbody = testParameters.get('maxbody', 8 * 1024 * 1024 if matcher else 10240)
+        self.report.debug("Reading response header from server")
+        response = plugins.basics.httpparser.response(testParameters.get('method', 'GET'), limit = maxbody, timer = self.report.timer,
+                                                      body = matcher.feed if matcher else None)
+        self.receive(request, response, lambda: response.ready)
+        request.status_code = "%u %s" % (response.status, response.reason)
+        self.report.debug("Server response code: %s", request.status_code)
+        if response.status > ise and ise > 0:
+            ISE = response.statusline
+        if response.server:
+            request.server = response.server
+            self.report.debug("Server software is: %s", request.server)
+        request.location = response.location
+        
+        # Did we catch an internal server error or equivalent? bork!
+        if ISE:
+            self.report.error('response', "Internal Server Error or equivalent bad message received: " + ISE)
+        
+        self.report.debug("Reading response body (up to %u bytes)", maxbody)
+        try:
+            self.receive(request, response, lambda: response.done or (matcher is not None and matcher.done))
+        except Exception as err:
+            self.report.debug("Could not read full response body: %s", err)
+            response.keepalive = False
+        if not response.done:
+            # We stopped before the end of the body, so the connection can't be reused
+            response.keepalive = False
             self.report.timer('data')
-            if data:
-                request.bytes += len(data)
+        self.report.note('bodybytes', response.bodybytes)
+        if response.truncated:
+            self.report.note('truncated', True)
+        if matcher:
+            self.report.note('matchtime', matcher.elapsed / 1000) # Microseconds
+            problems = matcher.failures()
+            digest = matcher.digest()
+            if digest:
+                self.report.note('sha256', digest)
+                if testParameters.get('sha256') and testParameters['sha256'].lower() != digest:
+                    problems.append("Response body has changed (sha256 is %s)" % digest)
+            if problems and not ISE:
+                self.report.error('content', "; ".join(problems))
+        return response
+    
+    def run(self, testParameters):
+        request = plugins.basics.socket.tcp(testParameters, self.report)
+        
+        try:
+            if not self.setup(request, testParameters):
+                return
+            self.send(request, testParameters)
+            self.collect(request, testParameters)
             self.report.debug("All went well, closing socket.")
-            request.socket.close()
+            request.close()
             self.report.timer('end')
         except Exception as err:
             print("Caught error:" + str(err))
             self.report.error('response', str(err))
-            
+
+def groupkey(testParameters):
+    """ Returns the connection a task can share with others (host, port, vhost, TLS),
+        or None if the task wants a connection of its own """
+    if testParameters.get('keepalive', False) != True:
+        return None
+    return (testParameters.get('host'), int(testParameters.get('port', 80)),
+            testParameters.get('vhost', testParameters.get('host', 'localhost')),
+            testParameters.get('type') == "https")
+
+def closed(request, err):
+    """ Returns True if an error means the server closed (or reset) the connection """
+    if isinstance(err, (ConnectionError, ssl.SSLEOFError)):
+        return True
+    return request._reader is not None and request._reader.eof
+
+def runmany(globalConfig, tasks, pipeline = False):
+    """ Runs a group of HTTP(S) tasks against the same host, port, vhost and
+        TLS setting over one persistent connection. With pipeline set, all
+        requests are sent up front and the responses read back in order.
+        Each task still gets its own test object and report, noting whether
+        it had a fresh connection or reused one. If the server closes the
+        connection, the remaining tasks go out on a new one. Like other
+        HTTP clients, a request that fails on a reused connection before
+        any of its response came in is tried once more on a new one, as
+        servers close idle connections whenever they like. """
+    tests = [test(globalConfig) for t in tasks]
+    request = None
+    retried = set()
+    i = 0
+    while i < len(tasks):
+        t = tests[i]
+        params = tasks[i]
+        reused = request is not None
+        received = request.bytes if reused else 0
+        try:
+            if request is None:
+                t.report.note('reused', False)
+                request = plugins.basics.socket.tcp(params, t.report)
+                if not t.setup(request, params):
+                    request.close()
+                    request = None
+                    i += 1
+                    continue
+            else:
+                t.report.note('reused', True)
+                t.report.debug("Reusing connection to %s:%u", request.realip, request.port)
+                request.report = t.report
+            # Send what we can on this connection
+            first = i
+            sent = first
+            for j in (range(i, len(tasks)) if pipeline else range(i, i + 1)):
+                try:
+                    tests[j].send(request, tasks[j], close = j == len(tasks) - 1)
+                    sent = j + 1
+                except OSError:
+                    if j == first:
+                        raise
+                    break # Server hung up on us, the rest go out on the next connection
+            response = None
+            for j in range(first, sent):
+                if j > first:
+                    tests[j].report.note('reused', True)
+                    request.report = tests[j].report
+                try:
+                    response = tests[j].collect(request, tasks[j])
+                except Exception as err:
+                    if j == first:
+                        raise
+                    # The connection went away with pipelined requests still
+                    # unanswered. Retry those one at a time on a new connection.
+                    tests[j].report.debug("Lost pipelined connection, retrying: %s", err)
+                    pipeline = False
+                    response = None
+                    break
+                tests[j].report.timer('end')
+                i = j + 1
+                if not response.keepalive:
+                    break
+            if response is None or not response.keepalive:
+                request.close()
+                request = None
+        except Exception as err:
+            if reused and i not in retried and request is not None and request.bytes == received and closed(request, err):
+                retried.add(i)
+                tests[i].report.debug("Server closed the reused connection, retrying on a new one: %s", err)
+                request.close()
+                request = None
+                continue
+            print("Caught error:" + str(err))
+            tests[i].report.error('response', str(err))
+            i += 1
+            if request:
+                request.close()
+                request = None
+    if request:
+        request.close()
+    return tests
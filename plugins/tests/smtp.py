@@ -43,20 +43,20 @@ class test:
             # If SSL, wrap the socket to OpenSSL via the built-in secure() call.
             SSL = testParameters.get('SSL', False)
             if SSL == True:
-                request.secure(SNI = testParameters.get('host'))
+                request.secure(SNI = testParameters.get('host'), resume = testParameters.get('resume', True))
             
             # Now we basically just read the first line of response and assume
             # eeeeverything is okay if that worked!
             self.report.debug("Connected, reading response")
             status = None
-            firstLine = next(request.readline()) # Just get the first line
+            firstLine = request.reader().readline() # Just get the first line
             self.report.debug("Got a line")
             self.report.timer('read')
             request.server = str(firstLine, 'utf-8') # convert from bytes to string
             request.status_code = "Connection accepted"
             status = True
             self.report.timer('data')
-            self.report.debug("Response from server was: %s" % request.server)
+            self.report.debug("Response from server was: %s", request.server)
             self.report.debug("All went well, closing socket.")
             self.report.timer('end')
             
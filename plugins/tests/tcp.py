@@ -43,7 +43,7 @@ class test:
             # If SSL, wrap the socket to OpenSSL via the built-in secure() call.
             SSL = testParameters.get('SSL', False)
             if SSL == True:
-                request.secure(SNI = testParameters.get('host'))
+                request.secure(SNI = testParameters.get('host'), resume = testParameters.get('resume', True))
             
             # We're connected, that's it! goodbye!
             self.report.debug("Connected to host")